@@ -0,0 +1,912 @@
+import logging
+import operator
+import re
+from itertools import count
+from typing import Callable, Iterable, Iterator
+
+
+import networkx as nx
+
+from provmap.graph.edge import Edge
+from provmap.graph.entities.entity import Entity
+from provmap.graph.entities.file import File
+from provmap.graph.entities.ftp_transaction import FtpTransaction
+from provmap.graph.entities.http_transaction import HttpTransaction
+from provmap.graph.entities.process import Process
+from provmap.graph.entities.socket import Socket
+from provmap.graph.graph import Graph
+
+
+logger = logging.getLogger(__name__)
+
+
+# Predicates the reasoner is queried for. Only their clauses, and those they
+# depend on, are read from the rules.
+QUERY_PREDICATES = ("malicious/1", "contaminated/1", "tag/2")
+
+_anonymous = count()
+
+
+class Var:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str | None = None) -> None:
+        # Unnamed variables are anonymous, like _ in Prolog
+        self.name = name if name is not None else f"_{next(_anonymous)}"
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+# A positive body literal or rule head: predicate name and arguments
+class Atom:
+    __slots__ = ("predicate", "args")
+
+    def __init__(self, name: str, *args) -> None:
+        # Relations are keyed by name and arity, as in Prolog
+        self.predicate = f"{name}/{len(args)}"
+        self.args = args
+
+    def __repr__(self) -> str:
+        name = self.predicate.rsplit("/", 1)[0]
+
+        return f"{name}({", ".join(map(repr, self.args))})"
+
+
+# A condition over bound variables, like \= or atom_contains/2
+class Test:
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable[..., bool], *args) -> None:
+        self.func = func
+        self.args = args
+
+    def __repr__(self) -> str:
+        return f"{self.func.__name__}({", ".join(map(repr, self.args))})"
+
+
+# Binds a variable to a value computed from bound variables, like
+# atomic_list_concat/2
+class Let:
+    __slots__ = ("var", "func", "args")
+
+    def __init__(self, var: Var, func: Callable, *args) -> None:
+        self.var = var
+        self.func = func
+        self.args = args
+
+    def __repr__(self) -> str:
+        return f"{self.var} = {self.func.__name__}({", ".join(map(repr, self.args))})"
+
+
+Literal = Atom | Test | Let
+
+
+class Rule:
+    def __init__(self, head: Atom, *body: Literal) -> None:
+        self.head = head
+        self.body = body
+
+    def __repr__(self) -> str:
+        return f"{self.head} :- {", ".join(map(repr, self.body))}."
+
+
+class Relation:
+    def __init__(self) -> None:
+        self.tuples: set[tuple] = set()
+        # Tuples by the values at some argument positions, built on first use
+        # and kept up to date as tuples are added
+        self.indexes: dict[tuple[int, ...], dict[tuple, list[tuple]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.tuples)
+
+    def add(self, tuples: Iterable[tuple]) -> set[tuple]:
+        new = set(tuples) - self.tuples
+        self.tuples |= new
+
+        for positions, index in self.indexes.items():
+            for t in new:
+                index.setdefault(tuple(t[i] for i in positions), []).append(t)
+
+        return new
+
+    def lookup(self, positions: tuple[int, ...], key: tuple) -> list[tuple]:
+        index = self.indexes.get(positions)
+
+        if index is None:
+            index = self.indexes[positions] = {}
+
+            for t in self.tuples:
+                index.setdefault(tuple(t[i] for i in positions), []).append(t)
+
+        return index.get(key, [])
+
+
+def value_of(arg, bindings: dict[str, object]):
+    return bindings[arg.name] if isinstance(arg, Var) else arg
+
+
+def match_atom(
+    atom: Atom, relation: Relation, bindings: dict[str, object]
+) -> Iterator[dict[str, object]]:
+    positions = []
+    key = []
+
+    for i, arg in enumerate(atom.args):
+        if not isinstance(arg, Var):
+            positions.append(i)
+            key.append(arg)
+
+        elif arg.name in bindings:
+            positions.append(i)
+            key.append(bindings[arg.name])
+
+    for t in relation.lookup(tuple(positions), tuple(key)):
+        extended = dict(bindings)
+
+        for arg, value in zip(atom.args, t):
+            if not isinstance(arg, Var):
+                continue
+
+            # A variable repeated within the literal must match itself
+            if extended.setdefault(arg.name, value) != value:
+                break
+
+        else:
+            yield extended
+
+
+def solve(
+    body: tuple[Literal, ...],
+    relations: dict[str, Relation],
+    bindings: dict[str, object],
+    delta: tuple[int, Relation] | None = None,
+    start: int = 0,
+) -> Iterator[dict[str, object]]:
+    # Left to right join of the body. delta replaces the relation of one
+    # literal with the tuples derived in the last round.
+    if start == len(body):
+        yield bindings
+        return
+
+    literal = body[start]
+
+    if isinstance(literal, Atom):
+        if delta is not None and delta[0] == start:
+            relation = delta[1]
+
+        else:
+            relation = relations.setdefault(literal.predicate, Relation())
+
+        for extended in match_atom(literal, relation, bindings):
+            yield from solve(body, relations, extended, delta, start + 1)
+
+    elif isinstance(literal, Test):
+        if literal.func(*(value_of(arg, bindings) for arg in literal.args)):
+            yield from solve(body, relations, bindings, delta, start + 1)
+
+    else:
+        value = literal.func(*(value_of(arg, bindings) for arg in literal.args))
+        bound = bindings.get(literal.var.name, value)
+
+        if bound == value:
+            extended = {**bindings, literal.var.name: value}
+            yield from solve(body, relations, extended, delta, start + 1)
+
+
+def fire(
+    rule: Rule,
+    relations: dict[str, Relation],
+    delta: tuple[int, Relation] | None = None,
+) -> set[tuple]:
+    body = rule.body
+
+    if delta is not None:
+        # Join from the new tuples outwards. Moving a literal earlier only
+        # binds variables sooner, so later tests still see them bound.
+        i, changed = delta
+        body = (body[i],) + body[:i] + body[i + 1 :]
+        delta = (0, changed)
+
+    return {
+        tuple(value_of(arg, bindings) for arg in rule.head.args)
+        for bindings in solve(body, relations, {}, delta)
+    }
+
+
+def strata(rules: list[Rule]) -> list[list[Rule]]:
+    # Rules grouped by mutually recursive head predicates, dependencies first
+    dependencies = nx.DiGraph()
+
+    for rule in rules:
+        dependencies.add_node(rule.head.predicate)
+
+        for literal in rule.body:
+            if isinstance(literal, Atom):
+                dependencies.add_edge(literal.predicate, rule.head.predicate)
+
+    condensed = nx.condensation(dependencies)
+
+    groups = []
+
+    for component in nx.topological_sort(condensed):
+        predicates = condensed.nodes[component]["members"]
+        group = [rule for rule in rules if rule.head.predicate in predicates]
+
+        if group:
+            groups.append(group)
+
+    return groups
+
+
+def evaluate(rules: list[Rule], relations: dict[str, Relation]) -> None:
+    # Semi-naive bottom-up evaluation. After a first full round, each round
+    # only joins against the tuples that are new since the previous one.
+    for group in strata(rules):
+        predicates = {rule.head.predicate for rule in group}
+
+        delta: dict[str, Relation] = {}
+
+        for rule in group:
+            new = relations.setdefault(rule.head.predicate, Relation()).add(
+                fire(rule, relations)
+            )
+
+            delta.setdefault(rule.head.predicate, Relation()).add(new)
+
+        while any(delta.values()):
+            derived: dict[str, set[tuple]] = {}
+
+            for rule in group:
+                for i, literal in enumerate(rule.body):
+                    if not isinstance(literal, Atom):
+                        continue
+
+                    if literal.predicate not in predicates:
+                        continue
+
+                    changed = delta.get(literal.predicate)
+
+                    if not changed:
+                        continue
+
+                    derived.setdefault(rule.head.predicate, set()).update(
+                        fire(rule, relations, (i, changed))
+                    )
+
+            delta = {}
+
+            for predicate, tuples in derived.items():
+                new = relations[predicate].add(tuples)
+                delta.setdefault(predicate, Relation()).add(new)
+
+
+def prolog_number(value):
+    # Numbers are written unquoted, so Prolog reads digit strings back as
+    # integers
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+
+    return value
+
+
+def entity_facts(entity: Entity) -> Iterator[tuple[str, tuple]]:
+    # The facts of Entity.to_prolog(), with values as Prolog reads them back
+    entity_id = entity.entity_id
+
+    if isinstance(entity, Process):
+        yield "process", (entity_id,)
+        yield "process_id", (entity_id, prolog_number(entity.process_id))
+        yield "process_name", (entity_id, entity.process_name)
+        yield "process_cmd", (entity_id, entity.encoded_process_cmd)
+
+    elif isinstance(entity, File):
+        yield "file", (entity_id,)
+        yield "file_path", (entity_id, entity.file_path)
+
+    elif isinstance(entity, Socket):
+        yield "socket", (entity_id,)
+        yield "socket_ip", (entity_id, entity.socket_ip)
+        yield "socket_port", (entity_id, prolog_number(entity.socket_port))
+
+    elif isinstance(entity, HttpTransaction):
+        yield "http_transaction", (entity_id,)
+        yield "http_transaction_uri", (entity_id, entity.uri)
+        yield "http_transaction_request_method", (entity_id, entity.request_method)
+        yield "http_transaction_response_code", (
+            entity_id,
+            prolog_number(entity.response_code),
+        )
+
+    elif isinstance(entity, FtpTransaction):
+        yield "ftp_transaction", (entity_id,)
+        yield "ftp_transaction_command", (entity_id, entity.command)
+        yield "ftp_transaction_arg", (entity_id, entity.arg)
+        yield "ftp_transaction_response_code", (
+            entity_id,
+            prolog_number(entity.response_code),
+        )
+
+    else:
+        yield "entity", (entity_id,)
+
+
+def edge_facts(edge: Edge, aggregate_edges: bool) -> Iterator[tuple[str, tuple]]:
+    yield "edge", (edge.source_id, edge.destination_id, edge.relation, edge.timestamp)
+
+    if aggregate_edges:
+        yield "edge_summary", (
+            edge.source_id,
+            edge.destination_id,
+            edge.relation,
+            edge.count,
+            edge.timestamp,
+            edge.last_timestamp,
+        )
+
+
+def graph_relations(graph: Graph) -> dict[str, Relation]:
+    facts: dict[str, list[tuple]] = {}
+
+    for entity in graph.iter_entities():
+        for predicate, args in entity_facts(entity):
+            facts.setdefault(predicate, []).append(args)
+
+    for edge in graph.iter_edges():
+        for predicate, args in edge_facts(edge, graph.aggregate_edges):
+            facts.setdefault(predicate, []).append(args)
+
+    relations: dict[str, Relation] = {}
+
+    for name, tuples in facts.items():
+        relations[f"{name}/{len(tuples[0])}"] = relation = Relation()
+        relation.add(tuples)
+
+    return relations
+
+
+PROLOG_TOKEN_REGEX = re.compile(
+    r"""
+    (?P<layout>\s+|%[^\n]*|/\*.*?\*/)
+    |(?P<var>[A-Z_][A-Za-z0-9_]*)
+    |(?P<name>[a-z][A-Za-z0-9_]*)
+    |(?P<quoted>'(?:[^'\\]|\\.|'')*')
+    |(?P<number>\d+(?:\.\d+)?)
+    |(?P<punct>[()\[\],|])
+    |(?P<solo>[!;])
+    |(?P<symbol>[+\-*/\\^<>=~:.?@#&$]+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Standard operators used by rules.pl and schema.pl, as (priority, type)
+PROLOG_INFIX_OPERATORS = {
+    ":-": (1200, "xfx"),
+    ";": (1100, "xfy"),
+    "->": (1050, "xfy"),
+    ",": (1000, "xfy"),
+    **{
+        op: (700, "xfx")
+        for op in ("=", "\\=", "==", "\\==", "<", ">", "=<", ">=", "=:=", "=\\=", "is")
+    },
+    "+": (500, "yfx"),
+    "-": (500, "yfx"),
+    "*": (400, "yfx"),
+    "/": (400, "yfx"),
+    ":": (200, "xfy"),
+}
+
+PROLOG_PREFIX_OPERATORS = {
+    ":-": (1200, "fx"),
+    "?-": (1200, "fx"),
+    "dynamic": (1150, "fx"),
+    "discontiguous": (1150, "fx"),
+    "multifile": (1150, "fx"),
+    "table": (1150, "fx"),
+    "\\+": (900, "fy"),
+    "-": (200, "fy"),
+}
+
+
+# Reads Prolog clauses into terms: Var for variables, str for atoms, int and
+# float for numbers, list for lists and Atom for compound terms
+class PrologReader:
+    def __init__(self, text: str) -> None:
+        # (kind, text, start, end) of every token
+        self.tokens: list[tuple[str, str, int, int]] = []
+
+        offset = 0
+
+        for match in PROLOG_TOKEN_REGEX.finditer(text):
+            if match.start() != offset:
+                raise ValueError(f"Unreadable Prolog source at offset {offset}")
+
+            offset = match.end()
+
+            if match.lastgroup != "layout":
+                self.tokens.append(
+                    (match.lastgroup, match.group(), match.start(), match.end())
+                )
+
+        if offset != len(text):
+            raise ValueError(f"Unreadable Prolog source at offset {offset}")
+
+        self.position = 0
+        self.variables: dict[str, Var] = {}
+
+    def clauses(self) -> Iterator:
+        while self.position < len(self.tokens):
+            # Variables are scoped to their clause
+            self.variables = {}
+
+            term, _ = self.term(1200)
+
+            if not self.at_end():
+                raise ValueError(f"Expected end of clause after {term}")
+
+            self.position += 1
+
+            yield term
+
+    def at_end(self) -> bool:
+        kind, text, _, end = self.peek()
+
+        return kind == "symbol" and text == "." and self.followed_by_layout(end)
+
+    def followed_by_layout(self, end: int) -> bool:
+        return (
+            self.position + 1 >= len(self.tokens)
+            or self.tokens[self.position + 1][2] > end
+        )
+
+    def peek(self) -> tuple[str, str, int, int]:
+        if self.position >= len(self.tokens):
+            return ("eof", "", -1, -1)
+
+        return self.tokens[self.position]
+
+    def expect(self, text: str) -> None:
+        if self.peek()[1] != text:
+            raise ValueError(f"Expected '{text}' but found '{self.peek()[1]}'")
+
+        self.position += 1
+
+    def term(self, max_priority: int) -> tuple[object, int]:
+        left, priority = self.primary(max_priority)
+
+        while True:
+            kind, text, _, _ = self.peek()
+
+            if kind not in ("name", "punct", "solo", "symbol") or self.at_end():
+                return left, priority
+
+            infix = PROLOG_INFIX_OPERATORS.get(text)
+
+            if infix is None or infix[0] > max_priority:
+                return left, priority
+
+            op_priority, op_type = infix
+            left_max = op_priority if op_type == "yfx" else op_priority - 1
+            right_max = op_priority if op_type == "xfy" else op_priority - 1
+
+            if priority > left_max:
+                return left, priority
+
+            self.position += 1
+            right, _ = self.term(right_max)
+
+            left, priority = Atom(text, left, right), op_priority
+
+    def primary(self, max_priority: int) -> tuple[object, int]:
+        kind, text, _, end = self.peek()
+        self.position += 1
+
+        if kind == "number":
+            return (float(text) if "." in text else int(text)), 0
+
+        if kind == "var":
+            if text == "_":
+                return Var(), 0
+
+            return self.variables.setdefault(text, Var(text)), 0
+
+        if text == "(":
+            term, _ = self.term(1200)
+            self.expect(")")
+
+            return term, 0
+
+        if text == "[":
+            items = []
+
+            if self.peek()[1] != "]":
+                items.append(self.term(999)[0])
+
+                while self.peek()[1] == ",":
+                    self.position += 1
+                    items.append(self.term(999)[0])
+
+            if self.peek()[1] == "|":
+                raise ValueError("Partial lists are not supported")
+
+            self.expect("]")
+
+            return items, 0
+
+        if kind == "quoted":
+            name = re.sub(
+                r"\\(.)",
+                lambda m: {"n": "\n", "t": "\t"}.get(m[1], m[1]),
+                text[1:-1].replace("''", "'"),
+            )
+
+        elif kind in ("name", "solo", "symbol"):
+            name = text
+
+        else:
+            raise ValueError(f"Unexpected '{text}' in Prolog source")
+
+        next_kind, next_text, next_start, _ = self.peek()
+
+        # Functional notation needs the bracket right after the name
+        if next_text == "(" and next_start == end:
+            self.position += 1
+            args = [self.term(999)[0]]
+
+            while self.peek()[1] == ",":
+                self.position += 1
+                args.append(self.term(999)[0])
+
+            self.expect(")")
+
+            return Atom(name, *args), 0
+
+        prefix = PROLOG_PREFIX_OPERATORS.get(name) if kind != "quoted" else None
+
+        if (
+            prefix is not None
+            and prefix[0] <= max_priority
+            and next_kind != "eof"
+            and not self.at_end()
+            and next_text not in (")", "]", ",", "|")
+            and next_text not in PROLOG_INFIX_OPERATORS
+        ):
+            op_priority, op_type = prefix
+            arg, _ = self.term(op_priority if op_type == "fy" else op_priority - 1)
+
+            return Atom(name, arg), op_priority
+
+        return name, 0
+
+
+def read_prolog(filepath: str) -> list:
+    with open(filepath, encoding="utf-8") as f:
+        return list(PrologReader(f.read()).clauses())
+
+
+def declared_predicates(clauses: list) -> set[str]:
+    # name/arity of every predicate declared multifile, as schema.pl does for
+    # the graph facts
+    declared = set()
+
+    for clause in clauses:
+        if not (isinstance(clause, Atom) and clause.predicate == ":-/1"):
+            continue
+
+        directive = clause.args[0]
+
+        if not (isinstance(directive, Atom) and directive.predicate == "multifile/1"):
+            continue
+
+        specs = [directive.args[0]]
+
+        while specs:
+            spec = specs.pop()
+
+            if isinstance(spec, Atom) and spec.predicate == ",/2":
+                specs.extend(spec.args)
+
+            elif isinstance(spec, Atom) and spec.predicate == "//2":
+                declared.add(f"{spec.args[0]}/{spec.args[1]}")
+
+    return declared
+
+
+def atom_text(value) -> str:
+    # Text of an atomic value as atomic_list_concat/2 writes it
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def concat(*values) -> str:
+    return "".join(atom_text(value) for value in values)
+
+
+def ends_with(value, suffix) -> bool:
+    return isinstance(value, str) and value.endswith(suffix)
+
+
+def contains(value, sub) -> bool:
+    return isinstance(value, str) and sub in value
+
+
+def differ(x, y) -> bool:
+    return x != y
+
+
+ARITHMETIC_FUNCTIONS: dict[str, Callable] = {
+    "+/2": operator.add,
+    "-/2": operator.sub,
+    "*/2": operator.mul,
+    "//2": operator.truediv,
+    "-/1": operator.neg,
+    "abs/1": abs,
+}
+
+ARITHMETIC_COMPARISONS: dict[str, Callable[..., bool]] = {
+    "</2": operator.lt,
+    ">/2": operator.gt,
+    "=</2": operator.le,
+    ">=/2": operator.ge,
+    "=:=/2": operator.eq,
+    "=\\=/2": operator.ne,
+}
+
+
+def term_variables(term) -> list[Var]:
+    if isinstance(term, Var):
+        return [term]
+
+    if isinstance(term, Atom):
+        return [var for arg in term.args for var in term_variables(arg)]
+
+    if isinstance(term, list):
+        return [var for item in term for var in term_variables(item)]
+
+    return []
+
+
+def arithmetic(expression, bindings: dict[str, object]):
+    if isinstance(expression, Var):
+        return bindings[expression.name]
+
+    if isinstance(expression, Atom):
+        return ARITHMETIC_FUNCTIONS[expression.predicate](
+            *(arithmetic(arg, bindings) for arg in expression.args)
+        )
+
+    return expression
+
+
+def check_arithmetic(expression, goal: Atom) -> None:
+    if isinstance(expression, Atom):
+        if expression.predicate not in ARITHMETIC_FUNCTIONS:
+            raise ValueError(f"Unsupported arithmetic in {goal}")
+
+        for arg in expression.args:
+            check_arithmetic(arg, goal)
+
+    elif not isinstance(expression, (Var, int, float)):
+        raise ValueError(f"Unsupported arithmetic in {goal}")
+
+
+def arithmetic_test(goal: Atom) -> Test:
+    for expression in goal.args:
+        check_arithmetic(expression, goal)
+
+    compare = ARITHMETIC_COMPARISONS[goal.predicate]
+    lhs, rhs = goal.args
+    variables = term_variables(goal)
+    names = [var.name for var in variables]
+
+    def test(*values) -> bool:
+        bindings = dict(zip(names, values))
+
+        return compare(arithmetic(lhs, bindings), arithmetic(rhs, bindings))
+
+    test.__name__ = repr(goal)
+
+    return Test(test, *variables)
+
+
+def concat_let(goal: Atom) -> Let:
+    parts, result = goal.args
+
+    if not isinstance(parts, list) or not isinstance(result, Var):
+        raise ValueError(f"Only atomic_list_concat(+List, -Atom) is supported: {goal}")
+
+    return Let(result, concat, *parts)
+
+
+# Goals evaluated in Python rather than through clauses: comparisons, and
+# the rules.pl helpers built on sub_atom/4
+NATIVE_GOALS: dict[str, Callable[[Atom], Literal]] = {
+    "\\==/2": lambda goal: Test(differ, *goal.args),
+    "\\=/2": lambda goal: Test(differ, *goal.args),
+    "atom_ends_with/2": lambda goal: Test(ends_with, *goal.args),
+    "atom_contains/2": lambda goal: Test(contains, *goal.args),
+    "atomic_list_concat/2": concat_let,
+    **{predicate: arithmetic_test for predicate in ARITHMETIC_COMPARISONS},
+}
+
+
+def body_alternatives(goal) -> list[list[Literal]]:
+    # Conjunctions of literals, one per branch of the disjunctions in goal
+    if goal == "true":
+        return [[]]
+
+    if not isinstance(goal, Atom):
+        raise ValueError(f"Unsupported goal {goal}")
+
+    if goal.predicate == ",/2":
+        return [
+            left + right
+            for left in body_alternatives(goal.args[0])
+            for right in body_alternatives(goal.args[1])
+        ]
+
+    if goal.predicate == ";/2":
+        return body_alternatives(goal.args[0]) + body_alternatives(goal.args[1])
+
+    native = NATIVE_GOALS.get(goal.predicate)
+
+    if native is not None:
+        return [[native(goal)]]
+
+    if any(isinstance(arg, (Atom, list)) for arg in goal.args):
+        raise ValueError(f"Unsupported goal {goal}")
+
+    return [[goal]]
+
+
+def check_range_restricted(rule: Rule) -> None:
+    # Every variable has to be bound by a relation before a test, a
+    # computed value or the head needs it
+    bound: set[str] = set()
+
+    for literal in rule.body:
+        if isinstance(literal, Atom):
+            bound.update(arg.name for arg in literal.args if isinstance(arg, Var))
+            continue
+
+        needed = [arg.name for arg in literal.args if isinstance(arg, Var)]
+
+        if not bound.issuperset(needed):
+            raise ValueError(f"Unbound variable in {rule}")
+
+        if isinstance(literal, Let):
+            bound.add(literal.var.name)
+
+    if not bound.issuperset(
+        arg.name for arg in rule.head.args if isinstance(arg, Var)
+    ):
+        raise ValueError(f"Unbound head variable in {rule}")
+
+
+def clause_parts(clause) -> tuple[Atom, object]:
+    if isinstance(clause, Atom) and clause.predicate == ":-/2":
+        head, body = clause.args
+
+    else:
+        head, body = clause, "true"
+
+    return (Atom(head) if isinstance(head, str) else head), body
+
+
+def program_rules(
+    clauses: list, queries: Iterable[str], facts: set[str]
+) -> list[Rule]:
+    # Rules for the queried predicates and everything they depend on.
+    # Clauses outside that subset are never translated, so helpers written
+    # in full Prolog do not have to be supported.
+    definitions: dict[str, list[tuple[Atom, object]]] = {}
+
+    for clause in clauses:
+        # Directives
+        if isinstance(clause, Atom) and clause.predicate == ":-/1":
+            continue
+
+        head, body = clause_parts(clause)
+        definitions.setdefault(head.predicate, []).append((head, body))
+
+    rules = []
+    pending = list(queries)
+    seen = set(pending)
+
+    while pending:
+        predicate = pending.pop()
+
+        if predicate not in definitions:
+            raise ValueError(f"No clauses for {predicate}")
+
+        for head, body in definitions[predicate]:
+            for literals in body_alternatives(body):
+                rule = Rule(head, *literals)
+                check_range_restricted(rule)
+                rules.append(rule)
+
+                for literal in literals:
+                    if not isinstance(literal, Atom) or literal.predicate in seen:
+                        continue
+
+                    if literal.predicate in definitions:
+                        seen.add(literal.predicate)
+                        pending.append(literal.predicate)
+
+                    elif literal.predicate not in facts:
+                        raise ValueError(f"Unknown predicate {literal.predicate}")
+
+    return rules
+
+
+# Bottom-up alternative to the Prolog Reasoner. It reads the same schema and
+# rules, evaluates them once over the graph, and answers queries from the
+# derived relations.
+class DatalogReasoner:
+    def __init__(
+        self,
+        graph: Graph,
+        schema: str,
+        rules: str,
+        queries: Iterable[str] = QUERY_PREDICATES,
+    ) -> None:
+        logger.info("Initialising datalog reasoner")
+        self.graph = graph
+
+        program = program_rules(
+            read_prolog(rules), queries, declared_predicates(read_prolog(schema))
+        )
+        logger.info(f"Read {len(program)} rules from {rules}")
+
+        self.relations = graph_relations(graph)
+        evaluate(program, self.relations)
+
+        logger.info(
+            f"Derived {sum(len(r) for r in self.relations.values())} facts"
+        )
+
+    def query(self, predicate: str) -> set[tuple]:
+        # All derived tuples of a predicate given as name/arity
+        relation = self.relations.get(predicate)
+
+        return relation.tuples if relation is not None else set()
+
+    def get_malicious_entities(self) -> list[Entity]:
+        logger.info("Searching for malicious entities")
+
+        entity_ids = {
+            t[0] for t in self.query("malicious/1") | self.query("contaminated/1")
+        }
+        logger.info(f"Found {len(entity_ids)} malicious entities")
+
+        return [self.graph.get_entity(entity_id) for entity_id in entity_ids]
+
+    def get_tags(self, entity: Entity) -> list[str]:
+        relation = self.relations.get("tag/2")
+
+        if relation is None:
+            return []
+
+        return list({tag for _, tag in relation.lookup((0,), (entity.entity_id,))})
+
+    def get_all_tags(
+        self, entities: Iterable[Entity] | None = None
+    ) -> dict[str, list[str]]:
+        if entities is None:
+            entity_ids = self.graph.get_entity_ids()
+
+        else:
+            entity_ids = [entity.entity_id for entity in entities]
+
+        tags: dict[str, dict[str, None]] = {
+            entity_id: {} for entity_id in entity_ids
+        }
+
+        for entity_id, tag in self.query("tag/2"):
+            if entity_id in tags:
+                tags[entity_id][tag] = None
+
+        return {entity_id: list(t) for entity_id, t in tags.items()}
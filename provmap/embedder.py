@@ -1,5 +1,6 @@
 import logging
 import pickle
+from typing import TYPE_CHECKING
 
 
 import numpy as np
@@ -17,28 +18,36 @@ from pykeen.hpo import hpo_pipeline
 from sklearn.decomposition import PCA
 
 from provmap.graph.graph import Graph
-from provmap.reasoner import Reasoner
+from provmap.datalog import DatalogReasoner
+
+# Only needed for annotations
+if TYPE_CHECKING:
+    from provmap.reasoner import Reasoner
 
 
 logger = logging.getLogger(__name__)
 
 
 class Embedder:
-    def __init__(self, graph: Graph, reasoner: Reasoner | None = None) -> None:
+    def __init__(
+        self, graph: Graph, reasoner: "Reasoner | DatalogReasoner | None" = None
+    ) -> None:
         logger.info("Initialising embedder")
         self.graph = graph
         self._model: ERModel | None = None
 
         triples = self.graph.to_triples(include_timestamp=False)
 
-        for entity_id in graph.G.nodes():
-            entity = graph.G.nodes[entity_id]["obj"]
+        all_tags = reasoner.get_all_tags() if reasoner else {}
+
+        for entity_id in graph.get_entity_ids():
+            entity = graph.get_entity(entity_id)
             entity_type = type(entity).__name__
 
             # triples.append((entity_id, "is", entity_type))
 
             if reasoner:
-                tags = reasoner.get_tags(graph.G.nodes[entity_id]["obj"])
+                tags = all_tags.get(entity_id, [])
 
                 tag_names = [tag.split("__")[0] for tag in tags]
                 tag_triples = [(entity_id, "has_tag", tag) for tag in tag_names]
@@ -238,7 +247,7 @@ class Embedder:
 
         # Filter out the tails of "is" and "has_tag"
         entities = [
-            (self.graph.G.nodes[i]["obj"] if i in self.graph.G else i)
+            (self.graph.get_entity(i) if self.graph.has_entity(i) else i)
             for i in entity_ids
         ]
 
@@ -5,5 +5,12 @@ from provmap.graph.graph import Graph
 
 @dataclass
 class Event:
-    def to_graph(self) -> Graph:
+    def add_to_graph(self, graph: Graph) -> None:
         raise NotImplementedError()
+
+    def to_graph(self) -> Graph:
+        graph = Graph()
+
+        self.add_to_graph(graph)
+
+        return graph
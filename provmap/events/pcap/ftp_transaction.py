@@ -27,11 +27,9 @@ class FtpTransaction(Event):
     arg: str
     response_code: int
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         if self.command != "STOR":
-            return graph
+            return
 
         client_socket = Socket(socket_ip=self.client_ip, socket_port=self.client_port)
         server_socket = Socket(socket_ip=self.server_ip, socket_port=self.server_port)
@@ -77,5 +75,3 @@ class FtpTransaction(Event):
                     timestamp=self.request_timestamp,
                 )
             )
-
-        return graph
@@ -20,9 +20,7 @@ class HttpTransaction(Event):
     request_method: str
     response_code: int
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         client_socket = Socket(socket_ip=self.client_ip, socket_port=self.client_port)
         server_socket = Socket(socket_ip=self.server_ip, socket_port=self.server_port)
 
@@ -50,5 +48,3 @@ class HttpTransaction(Event):
                 timestamp=self.response_timestamp,
             )
         )
-
-        return graph
@@ -19,9 +19,7 @@ class FileCreate(Event):
     creation_utc_time: float
     user: str
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         process = Process(
             process_id=self.process_id,
             process_name=PureWindowsPath(self.image).name,
@@ -56,5 +54,3 @@ class FileCreate(Event):
                 timestamp=self.utc_time,
             )
         )
-
-        return graph
@@ -17,9 +17,7 @@ class ImageLoaded(Event):
     image: str
     image_loaded: str
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         process = Process(
             process_id=self.process_id,
             process_name=PureWindowsPath(self.image).name,
@@ -50,5 +48,3 @@ class ImageLoaded(Event):
                 timestamp=self.utc_time,
             )
         )
-
-        return graph
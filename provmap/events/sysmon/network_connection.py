@@ -31,9 +31,7 @@ class NetworkConnection(Event):
     destination_port: int
     destination_port_name: str
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         process = Process(
             process_id=self.process_id,
             process_name=Path(self.image).name,
@@ -82,5 +80,3 @@ class NetworkConnection(Event):
                 timestamp=self.utc_time,
             )
         )
-
-        return graph
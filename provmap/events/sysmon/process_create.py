@@ -1,9 +1,9 @@
 import os
 from pathlib import PureWindowsPath
 import re
-import shlex
 from base64 import b64decode
 from dataclasses import dataclass
+from functools import lru_cache
 
 
 from provmap.events.event import Event
@@ -13,35 +13,76 @@ from provmap.graph.entities.process import Process
 from provmap.graph.graph import Graph
 
 
+# Possessive quantifiers keep matching linear in the token length. Only whole
+# directory segments are ever given back, which is all the original pattern
+# could usefully backtrack over.
 WINDOWS_PATH_REGEX = re.compile(
-    r"((?:[A-Za-z]:(?:/|\\)+)(?:(?:[^<>:\"/\\|?*\n]+(?:/|\\)+)+)(?:[^<>:\"/\\|?*\n]+(?:\w+)))"
+    r"((?:[A-Za-z]:[/\\]++)(?:(?:[^<>:\"/\\|?*\n]++[/\\]++)+)(?:[^<>:\"/\\|?*\n]+\w))"
 )
 
+# Tokens as produced by shlex.split(posix=False): quoted strings keep their
+# quotes and end the token, anything else runs until whitespace. A quote
+# without its closing partner is matched by the last alternative.
+COMMAND_LINE_TOKEN_REGEX = re.compile(
+    r"\"[^\"]*\"|'[^']*'|[^ \t\r\n\"'][^ \t\r\n]*|([\"'])"
+)
+
+# Tokens b64decode could turn into something holding a path. It discards
+# characters outside the alphabet, and the shortest path the regex accepts is
+# 7 characters, which takes at least 10 alphabet characters.
+BASE64_TOKEN_REGEX = re.compile(r"(?:[^A-Za-z0-9+/]*+[A-Za-z0-9+/]){10}")
+
+COMMAND_LINE_CACHE_SIZE = 4096
+
+
+def split_command_line(command_line: str) -> list[str] | None:
+    tokens = []
+
+    for match in COMMAND_LINE_TOKEN_REGEX.finditer(command_line):
+        if match.group(1) is not None:
+            return None
+
+        tokens.append(match.group())
+
+    return tokens
+
+
+def decode_base64_token(token: str) -> str | None:
+    if BASE64_TOKEN_REGEX.match(token) is None:
+        return None
 
-def extract_filepaths(command_line: str) -> list[str]:
     try:
-        tokens = shlex.split(command_line, posix=False)
-    
+        return b64decode(token).decode().replace("\x00", "")
+
     except:
-        return []
+        return None
 
-    decoded_tokens = []
 
-    for token in tokens:
-        try:
-            decoded = b64decode(token).decode().replace("\x00", "")
+@lru_cache(maxsize=COMMAND_LINE_CACHE_SIZE)
+def cached_filepaths(command_line: str) -> tuple[str, ...]:
+    tokens = split_command_line(command_line)
 
-            decoded_tokens.append(decoded)
+    if tokens is None:
+        return ()
 
-        except:
-            pass
+    decoded_tokens = [
+        decoded
+        for decoded in map(decode_base64_token, tokens)
+        if decoded is not None
+    ]
 
     matches = []
 
     for token in tokens + decoded_tokens:
         matches.extend(WINDOWS_PATH_REGEX.findall(token))
 
-    return [os.path.normpath(m.lower().strip()) for m in matches]
+    return tuple(os.path.normpath(m.lower().strip()) for m in matches)
+
+
+def extract_filepaths(command_line: str) -> list[str]:
+    # Parent command lines repeat across many events, so results are cached
+    # per distinct command line
+    return list(cached_filepaths(command_line))
 
 
 @dataclass
@@ -69,9 +110,7 @@ class ProcessCreate(Event):
     parent_command_line: str
     parent_user: str
 
-    def to_graph(self) -> Graph:
-        graph = Graph()
-
+    def add_to_graph(self, graph: Graph) -> None:
         parent_process = Process(
             process_id=self.parent_process_id,
             process_name=PureWindowsPath(self.parent_image).name,
@@ -149,5 +188,3 @@ class ProcessCreate(Event):
                         timestamp=self.utc_time,
                     )
                 )
-
-        return graph
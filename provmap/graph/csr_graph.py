@@ -0,0 +1,554 @@
+import logging
+import pickle
+import sys
+from array import array
+from typing import Iterator
+
+
+import numpy as np
+
+
+from provmap.graph.edge import Edge
+from provmap.graph.entities.entity import Entity
+from provmap.graph.graph import Graph
+
+
+logger = logging.getLogger(__name__)
+
+
+# Array-backed graph with the same public API as Graph. Entities are addressed
+# by integer indices, edges are kept as parallel arrays and traversals use CSR
+# adjacency built from them on demand.
+class CSRGraph(Graph):
+    def __init__(self, aggregate_edges: bool = False) -> None:
+        self._aggregate_edges: bool = aggregate_edges
+
+        self._entity_ids: list[str] = []
+        self._entities: list[Entity] = []
+        self._index: dict[str, int] = {}
+
+        self._relations: list[str] = []
+        self._relation_index: dict[str, int] = {}
+
+        self._src = array("q")
+        self._dst = array("q")
+        self._rel = array("q")
+        self._ts = array("d")
+        self._last_ts = array("d")
+        self._count = array("q")
+
+        self._compacted: bool = True
+        self._csr_out: tuple[np.ndarray, np.ndarray] | None = None
+        self._csr_in: tuple[np.ndarray, np.ndarray] | None = None
+        self._time_index: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None
+
+    @property
+    def aggregate_edges(self) -> bool:
+        return self._aggregate_edges
+
+    @property
+    def number_of_entities(self) -> int:
+        return len(self._entity_ids)
+
+    @property
+    def number_of_edges(self) -> int:
+        self._compact()
+
+        return len(self._src)
+
+    def add_entity(self, entity: Entity) -> None:
+        entity_id = entity.entity_id
+
+        i = self._index.get(entity_id)
+
+        if i is None:
+            self._index[entity_id] = len(self._entity_ids)
+            self._entity_ids.append(entity_id)
+            self._entities.append(entity)
+
+            return
+
+        self._entities[i] = self._entities[i].combine(entity)
+
+    def get_entity(self, entity_id: str) -> Entity:
+        return self._entities[self._index[entity_id]]
+
+    def has_entity(self, entity_id: str) -> bool:
+        return entity_id in self._index
+
+    def get_entity_ids(self) -> list[str]:
+        return list(self._entity_ids)
+
+    def iter_entities(self) -> Iterator[Entity]:
+        yield from self._entities
+
+    def iter_edges(self) -> Iterator[Edge]:
+        src, dst, rel, ts = self._edge_arrays()
+        last_ts, count = self._edge_stats()
+
+        entities = self._entities
+        relations = self._relations
+
+        for u, v, r, t, lt, c in zip(
+            src.tolist(),
+            dst.tolist(),
+            rel.tolist(),
+            ts.tolist(),
+            last_ts.tolist(),
+            count.tolist(),
+        ):
+            yield Edge(entities[u], entities[v], relations[r], t, lt, c)
+
+    def add_edge(self, edge: Edge) -> None:
+        u = self._index.get(edge.source_id)
+        v = self._index.get(edge.destination_id)
+
+        if u is None:
+            raise ValueError()
+
+        if v is None:
+            raise ValueError()
+
+        r = self._relation_index.get(edge.relation)
+
+        if r is None:
+            r = len(self._relations)
+            self._relation_index[edge.relation] = r
+            self._relations.append(sys.intern(edge.relation))
+
+        self._src.append(u)
+        self._dst.append(v)
+        self._rel.append(r)
+        self._ts.append(edge.timestamp)
+        self._last_ts.append(edge.last_timestamp)
+        self._count.append(edge.count)
+
+        self._compacted = False
+        self._csr_out = None
+        self._csr_in = None
+        self._time_index = None
+
+    def extend(self, newer: Graph) -> "CSRGraph":
+        new = self
+
+        for e in newer.iter_entities():
+            i = new._index.get(e.entity_id)
+
+            if i is None:
+                new.add_entity(e)
+
+            else:
+                new._entities[i] = e.combine(new._entities[i])
+
+        if new.aggregate_edges:
+            for edge in newer.iter_edges():
+                new.add_edge(edge)
+
+            return new
+
+        src, dst, rel, ts = new._edge_arrays()
+        relations = new._relations
+        existing = set(
+            zip(src.tolist(), dst.tolist(), [relations[r] for r in rel.tolist()])
+        )
+
+        # Release the buffer views, the arrays cannot grow while they exist
+        del src, dst, rel, ts
+
+        for edge in newer.iter_edges():
+            key = (
+                new._index[edge.source_id],
+                new._index[edge.destination_id],
+                edge.relation,
+            )
+
+            if key in existing:
+                continue
+
+            new.add_edge(edge)
+
+        return new
+
+    def subgraph(self, entities: list[Entity]) -> "CSRGraph":
+        n = self.number_of_entities
+
+        keep = np.zeros(n, dtype=bool)
+        keep[[self._index[e.entity_id] for e in entities]] = True
+
+        return self._induced(keep)
+
+    def window(self, start: float, end: float) -> "CSRGraph":
+        # Edges with start <= timestamp < end, together with their endpoints.
+        # As in Graph.window, aggregated edges are kept when their interval
+        # overlaps the window and keep their whole-log count and timestamps
+        timestamps, reach, order = self._get_time_index()
+
+        lo = np.searchsorted(reach, start, side="left")
+        hi = np.searchsorted(timestamps, end, side="left")
+
+        last_ts, _ = self._edge_stats()
+
+        edges = order[lo:hi]
+        edges = np.sort(edges[last_ts[edges] >= start])
+
+        src, dst, _, _ = self._edge_arrays()
+
+        keep = np.zeros(self.number_of_entities, dtype=bool)
+        keep[src[edges]] = True
+        keep[dst[edges]] = True
+
+        return self._induced(keep, edges)
+
+    def trace(self, source_id: str) -> "CSRGraph":
+        i = self._index[source_id]
+
+        indptr, col = self._csr(reverse=False)
+        next_nodes = self._reachable(i, indptr, col)
+
+        indptr, col = self._csr(reverse=True)
+        prev_nodes = self._reachable(i, indptr, col)
+
+        keep = next_nodes | prev_nodes
+        keep[i] = True
+
+        return self._induced(keep)
+
+    def get_roots(self) -> list[str]:
+        in_degree, out_degree = self._degrees()
+
+        return self._ids_where((in_degree == 0) & (out_degree > 0))
+
+    def get_leaves(self) -> list[str]:
+        in_degree, out_degree = self._degrees()
+
+        return self._ids_where((in_degree > 0) & (out_degree == 0))
+
+    def to_walks(self, label: bool = False) -> list[list[str]]:
+        indptr, col = self._csr(reverse=False)
+        _, _, rel, _ = self._edge_arrays()
+        order = self._out_order()
+
+        leaves = set(self._index[leaf] for leaf in self.get_leaves())
+
+        def name(i: int) -> str:
+            return self._entities[i].label if label else self._entity_ids[i]
+
+        walks = []
+
+        for root in self.get_roots():
+            start = self._index[root]
+
+            # Iterative DFS over simple paths, one frame per node on the path
+            path_nodes = [start]
+            path_relations: list[str] = []
+            on_path = {start}
+            stack = [iter(range(indptr[start], indptr[start + 1]))]
+
+            while stack:
+                k = next(stack[-1], None)
+
+                if k is None:
+                    stack.pop()
+                    on_path.discard(path_nodes.pop())
+
+                    if path_relations:
+                        path_relations.pop()
+
+                    continue
+
+                v = int(col[k])
+
+                if v in on_path:
+                    continue
+
+                path_nodes.append(v)
+                path_relations.append(self._relations[rel[order[k]]])
+
+                if v in leaves:
+                    walk = []
+
+                    for u, r in zip(path_nodes, path_relations):
+                        walk.extend([name(u), r])
+
+                    walk.append(name(v))
+                    walks.append(walk)
+
+                on_path.add(v)
+                stack.append(iter(range(indptr[v], indptr[v + 1])))
+
+        return walks
+
+    def to_graphviz(self) -> str:
+        lines = ["digraph{\n\toverlap=false;\n"]
+
+        for entity in self._entities:
+            lines.append("\t" + entity.to_graphviz() + "\n")
+
+        for edge in self.iter_edges():
+            lines.append("\t" + edge.to_graphviz() + "\n")
+
+        lines.append("}")
+
+        return "".join(lines)
+
+    def to_prolog(self) -> str:
+        entities = []
+
+        for entity in self._entities:
+            entities.extend(entity.to_prolog().split("\n"))
+
+        edges = []
+
+        for edge in self.iter_edges():
+            edges.append(edge.to_prolog())
+
+            if self.aggregate_edges:
+                edges.append(edge.to_prolog_summary())
+
+        entities.sort()
+        edges.sort()
+
+        return "\n".join(entities + edges)
+
+    def to_triples(
+        self,
+        include_timestamp=True,
+    ) -> list[tuple]:
+        src, dst, rel, ts = self._edge_arrays()
+        last_ts, count = self._edge_stats()
+
+        ids = np.array(self._entity_ids, dtype=object)
+        relations = np.array(self._relations, dtype=object)
+
+        h = ids[src].tolist()
+        r = relations[rel].tolist()
+        t = ids[dst].tolist()
+
+        if include_timestamp and self.aggregate_edges:
+            return list(zip(h, r, t, ts.tolist(), last_ts.tolist(), count.tolist()))
+
+        if include_timestamp:
+            return list(zip(h, r, t, ts.tolist()))
+
+        return list(zip(h, r, t))
+
+    def to_pickle(self) -> bytes:
+        self._compact()
+
+        return pickle.dumps(
+            (
+                self._aggregate_edges,
+                self._entities,
+                self._relations,
+                self._src,
+                self._dst,
+                self._rel,
+                self._ts,
+                self._last_ts,
+                self._count,
+            )
+        )
+
+    @staticmethod
+    def from_pickle(pkl: bytes) -> "CSRGraph":
+        (
+            aggregate_edges,
+            entities,
+            relations,
+            src,
+            dst,
+            rel,
+            ts,
+            last_ts,
+            count,
+        ) = pickle.loads(pkl)
+
+        graph = CSRGraph(aggregate_edges)
+
+        for entity in entities:
+            graph.add_entity(entity)
+
+        graph._relations = relations
+        graph._relation_index = {r: i for i, r in enumerate(relations)}
+
+        graph._src = src
+        graph._dst = dst
+        graph._rel = rel
+        graph._ts = ts
+        graph._last_ts = last_ts
+        graph._count = count
+
+        return graph
+
+    def _edge_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        self._compact()
+
+        return (
+            np.frombuffer(self._src, dtype=np.int64),
+            np.frombuffer(self._dst, dtype=np.int64),
+            np.frombuffer(self._rel, dtype=np.int64),
+            np.frombuffer(self._ts, dtype=np.float64),
+        )
+
+    def _edge_stats(self) -> tuple[np.ndarray, np.ndarray]:
+        self._compact()
+
+        return (
+            np.frombuffer(self._last_ts, dtype=np.float64),
+            np.frombuffer(self._count, dtype=np.int64),
+        )
+
+    def _compact(self) -> None:
+        # Collapse repeated (source, destination, relation) edges. As in
+        # Graph.add_edge, a repeated edge keeps the position of its first
+        # insertion and either the data of its last or, when aggregating, the
+        # earliest timestamp, the latest timestamp and the summed count
+        if self._compacted:
+            return
+
+        src = np.frombuffer(self._src, dtype=np.int64)
+        dst = np.frombuffer(self._dst, dtype=np.int64)
+        rel = np.frombuffer(self._rel, dtype=np.int64)
+        ts = np.frombuffer(self._ts, dtype=np.float64)
+        last_ts = np.frombuffer(self._last_ts, dtype=np.float64)
+        count = np.frombuffer(self._count, dtype=np.int64)
+
+        m = len(src)
+        pos = np.arange(m)
+
+        order = np.lexsort((pos, rel, dst, src))
+
+        s, d, r = src[order], dst[order], rel[order]
+        starts = np.ones(m, dtype=bool)
+        starts[1:] = (s[1:] != s[:-1]) | (d[1:] != d[:-1]) | (r[1:] != r[:-1])
+
+        group_starts = np.flatnonzero(starts)
+
+        first = order[group_starts]
+        last = order[np.append(group_starts[1:] - 1, m - 1)]
+
+        if self._aggregate_edges:
+            new_ts = np.minimum.reduceat(ts[order], group_starts)
+            new_last_ts = np.maximum.reduceat(last_ts[order], group_starts)
+            new_count = np.add.reduceat(count[order], group_starts)
+
+        else:
+            new_ts = ts[last]
+            new_last_ts = last_ts[last]
+            new_count = count[last]
+
+        by_position = np.argsort(first, kind="stable")
+        first = first[by_position]
+
+        self._src = array("q", src[first].tobytes())
+        self._dst = array("q", dst[first].tobytes())
+        self._rel = array("q", rel[first].tobytes())
+        self._ts = array("d", new_ts[by_position].tobytes())
+        self._last_ts = array("d", new_last_ts[by_position].tobytes())
+        self._count = array("q", new_count[by_position].tobytes())
+
+        self._compacted = True
+
+    def _out_order(self) -> np.ndarray:
+        src, _, _, _ = self._edge_arrays()
+
+        return np.argsort(src, kind="stable")
+
+    def _csr(self, reverse: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        cached = self._csr_in if reverse else self._csr_out
+
+        if cached is not None and self._compacted:
+            return cached
+
+        src, dst, _, _ = self._edge_arrays()
+
+        if reverse:
+            src, dst = dst, src
+
+        order = np.argsort(src, kind="stable")
+
+        indptr = np.zeros(self.number_of_entities + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=self.number_of_entities), out=indptr[1:])
+
+        csr = (indptr, dst[order])
+
+        if reverse:
+            self._csr_in = csr
+        else:
+            self._csr_out = csr
+
+        return csr
+
+    def _reachable(self, i: int, indptr: np.ndarray, col: np.ndarray) -> np.ndarray:
+        visited = np.zeros(self.number_of_entities, dtype=bool)
+        frontier = np.array([i], dtype=np.int64)
+
+        while len(frontier):
+            starts = indptr[frontier]
+            lengths = indptr[frontier + 1] - starts
+
+            total = int(lengths.sum())
+
+            if total == 0:
+                break
+
+            # Gather the concatenated neighbour ranges of the whole frontier
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            neighbours = col[offsets + np.arange(total)]
+
+            frontier = np.unique(neighbours[~visited[neighbours]])
+            visited[frontier] = True
+
+        return visited
+
+    def _degrees(self) -> tuple[np.ndarray, np.ndarray]:
+        src, dst, _, _ = self._edge_arrays()
+
+        n = self.number_of_entities
+
+        return (np.bincount(dst, minlength=n), np.bincount(src, minlength=n))
+
+    def _ids_where(self, mask: np.ndarray) -> list[str]:
+        return [self._entity_ids[i] for i in np.flatnonzero(mask).tolist()]
+
+    def _get_time_index(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Sorted timestamps, the running maximum of last timestamps in that
+        # order, and the edge positions they belong to
+        if self._time_index is None or not self._compacted:
+            _, _, _, ts = self._edge_arrays()
+            last_ts, _ = self._edge_stats()
+
+            order = np.argsort(ts, kind="stable")
+            reach = np.maximum.accumulate(last_ts[order])
+
+            self._time_index = (ts[order], reach, order)
+
+        return self._time_index
+
+    def _induced(
+        self, keep: np.ndarray, edges: np.ndarray | None = None
+    ) -> "CSRGraph":
+        src, dst, rel, ts = self._edge_arrays()
+        last_ts, count = self._edge_stats()
+
+        new = CSRGraph(self._aggregate_edges)
+
+        for i in np.flatnonzero(keep).tolist():
+            new.add_entity(self._entities[i])
+
+        remap = np.cumsum(keep) - 1
+
+        if edges is None:
+            edges = keep[src] & keep[dst]
+
+        new._relations = list(self._relations)
+        new._relation_index = dict(self._relation_index)
+
+        new._src = array("q", remap[src[edges]].tobytes())
+        new._dst = array("q", remap[dst[edges]].tobytes())
+        new._rel = array("q", rel[edges].tobytes())
+        new._ts = array("d", ts[edges].tobytes())
+        new._last_ts = array("d", last_ts[edges].tobytes())
+        new._count = array("q", count[edges].tobytes())
+
+        return new
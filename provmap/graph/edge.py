@@ -1,4 +1,6 @@
+import copy
 import logging
+import sys
 from datetime import datetime
 
 
@@ -9,43 +11,81 @@ logger = logging.getLogger(__name__)
 
 
 class Edge:
+    __slots__ = (
+        "source_id",
+        "destination_id",
+        "relation",
+        "timestamp",
+        "last_timestamp",
+        "count",
+    )
+
     def __init__(
         self,
         source: Entity,
         destination: Entity,
         relation: str,
         timestamp: float,
+        last_timestamp: float | None = None,
+        count: int = 1,
     ) -> None:
-        self.source = source
-        self.destination = destination
-        self.relation = relation
-        self.timestamp = timestamp
+        # Endpoints are kept by ID so that edges never hold stale copies of
+        # entities that have since been combined in the graph
+        self.source_id: str = source.entity_id
+        self.destination_id: str = destination.entity_id
+        self.relation: str = sys.intern(relation)
+        self.timestamp: float = timestamp
+        self.last_timestamp: float = (
+            last_timestamp if last_timestamp is not None else timestamp
+        )
+        self.count: int = count
+
+    def aggregate(self, other: "Edge") -> "Edge":
+        if self != other:
+            raise ValueError()
+
+        new = copy.copy(self)
+
+        new.timestamp = min(self.timestamp, other.timestamp)
+        new.last_timestamp = max(self.last_timestamp, other.last_timestamp)
+        new.count = self.count + other.count
+
+        return new
 
     def to_graphviz(self) -> str:
-        src = self.source.entity_id
-        dst = self.destination.entity_id
+        src = self.source_id
+        dst = self.destination_id
 
         dt = datetime.fromtimestamp(self.timestamp)
         label = (
             f"{self.relation} @ {dt.strftime("%H:%M:%S")}.{dt.microsecond // 1000:03d}"
         )
 
+        if self.count > 1:
+            label += f" (x{self.count})"
+
         return f'"{src}" -> "{dst}" [label="{label}", relation="{self.relation}", timestamp={self.timestamp}];'
 
     def to_prolog(self) -> str:
-        src = self.source.entity_id
-        dst = self.destination.entity_id
+        src = self.source_id
+        dst = self.destination_id
 
         return f"edge('{src}', '{dst}', {self.relation}, {self.timestamp})."
 
+    def to_prolog_summary(self) -> str:
+        src = self.source_id
+        dst = self.destination_id
+
+        return f"edge_summary('{src}', '{dst}', {self.relation}, {self.count}, {self.timestamp}, {self.last_timestamp})."
+
     def __eq__(self, value: object) -> bool:
         if not isinstance(value, Edge):
             return False
 
         return all(
             [
-                self.source == value.source,
-                self.destination == value.destination,
+                self.source_id == value.source_id,
+                self.destination_id == value.destination_id,
                 self.relation == value.relation,
                 # self.timestamp == value.timestamp, # Intentionally left out
             ]
@@ -1,12 +1,18 @@
 import logging
+import sys
 
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on memoised entity IDs kept per entity type
+ENTITY_ID_CACHE_SIZE = 1 << 16
+
 
 class Entity:
+    __slots__ = ("entity_id",)
+
     def __init__(self, entity_id: str) -> None:
-        self.entity_id = entity_id
+        self.entity_id = sys.intern(entity_id)
 
     def generate_entity_id(self) -> str:
         raise NotImplementedError()
@@ -1,15 +1,24 @@
+import sys
+from functools import lru_cache
 from hashlib import sha256
 
-from provmap.graph.entities.entity import Entity
+from provmap.graph.entities.entity import ENTITY_ID_CACHE_SIZE, Entity
+
+
+@lru_cache(maxsize=ENTITY_ID_CACHE_SIZE)
+def file_entity_id(file_path: str) -> str:
+    return sys.intern("file_" + sha256(file_path.encode()).hexdigest())
 
 
 class File(Entity):
+    __slots__ = ("file_path",)
+
     def __init__(
         self,
         file_path: str,
         entity_id: str | None = None,
     ) -> None:
-        self.file_path = file_path
+        self.file_path = sys.intern(file_path)
 
         entity_id = entity_id if entity_id else self.generate_entity_id()
         super().__init__(entity_id)
@@ -19,7 +28,7 @@ class File(Entity):
         return self.file_path.replace("\\", "\\\\")
 
     def generate_entity_id(self) -> str:
-        return "file_" + sha256(self.file_path.encode()).hexdigest()
+        return file_entity_id(self.file_path)
 
     @property
     def label(self) -> str:
@@ -4,6 +4,8 @@ from provmap.graph.entities.entity import Entity
 
 
 class FtpTransaction(Entity):
+    __slots__ = ("command", "arg", "response_code")
+
     def __init__(
         self,
         command: str,
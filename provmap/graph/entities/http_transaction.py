@@ -5,6 +5,8 @@ from provmap.graph.entities.entity import Entity
 
 
 class HttpTransaction(Entity):
+    __slots__ = ("uri", "request_method", "response_code")
+
     def __init__(
         self,
         uri: str,
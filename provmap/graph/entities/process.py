@@ -1,4 +1,5 @@
 import logging
+import sys
 
 
 from provmap.graph.entities.entity import Entity
@@ -8,6 +9,8 @@ logger = logging.getLogger(__name__)
 
 
 class Process(Entity):
+    __slots__ = ("process_id", "process_name", "process_cmd")
+
     def __init__(
         self,
         process_id: int,
@@ -16,7 +19,7 @@ class Process(Entity):
         entity_id: str | None = None,
     ) -> None:
         self.process_id = process_id
-        self.process_name = process_name
+        self.process_name = sys.intern(process_name)
         self.process_cmd = process_cmd
 
         entity_id = entity_id if entity_id else self.generate_entity_id()
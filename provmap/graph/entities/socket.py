@@ -1,18 +1,28 @@
-from provmap.graph.entities.entity import Entity
+import sys
+from functools import lru_cache
+
+from provmap.graph.entities.entity import ENTITY_ID_CACHE_SIZE, Entity
+
+
+@lru_cache(maxsize=ENTITY_ID_CACHE_SIZE)
+def socket_entity_id(socket_ip: str, socket_port: int) -> str:
+    return sys.intern(f"{socket_ip}_{socket_port}".replace(":", "."))
 
 
 class Socket(Entity):
+    __slots__ = ("socket_ip", "socket_port")
+
     def __init__(
         self, socket_ip: str, socket_port: int, entity_id: str | None = None
     ) -> None:
-        self.socket_ip = socket_ip
+        self.socket_ip = sys.intern(str(socket_ip))
         self.socket_port = socket_port
 
         entity_id = entity_id if entity_id else self.generate_entity_id()
         super().__init__(entity_id)
 
     def generate_entity_id(self) -> str:
-        return f"{self.socket_ip}_{self.socket_port}".replace(":", ".")
+        return socket_entity_id(self.socket_ip, self.socket_port)
 
     @property
     def label(self) -> str:
@@ -1,5 +1,8 @@
 import logging
 import pickle
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Iterator
 
 
 import networkx as nx
@@ -13,8 +16,17 @@ logger = logging.getLogger(__name__)
 
 
 class Graph:
-    def __init__(self) -> None:
-        self.G: nx.MultiDiGraph = nx.MultiDiGraph()
+    def __init__(self, aggregate_edges: bool = False) -> None:
+        self.G: nx.MultiDiGraph = nx.MultiDiGraph(aggregate_edges=aggregate_edges)
+        self._time_index: (
+            tuple[list[float], list[float], list[tuple[str, str, str]]] | None
+        ) = None
+
+    @property
+    def aggregate_edges(self) -> bool:
+        # Repeated edges are merged into one edge with an occurrence count and
+        # first/last timestamps instead of overwriting each other
+        return self.G.graph.get("aggregate_edges", False)
 
     @property
     def number_of_entities(self) -> int:
@@ -41,38 +53,71 @@ class Graph:
     def get_entity(self, entity_id: str) -> Entity:
         return self.G.nodes[entity_id]["obj"]
 
+    def has_entity(self, entity_id: str) -> bool:
+        return entity_id in self.G.nodes
+
+    def get_entity_ids(self) -> list[str]:
+        return list(self.G.nodes())
+
+    def iter_entities(self) -> Iterator[Entity]:
+        for _, n in self.G.nodes(data=True):
+            yield n["obj"]
+
+    def iter_edges(self) -> Iterator[Edge]:
+        for _, _, _, e in self.G.edges(keys=True, data=True):
+            yield e["obj"]
+
     def add_edge(self, edge: Edge) -> None:
-        source: Entity = edge.source
-        destination: Entity = edge.destination
+        source_id: str = edge.source_id
+        destination_id: str = edge.destination_id
         relation: str = edge.relation
-        timestamp: float = edge.timestamp
 
-        if source.entity_id not in self.G.nodes:
+        if source_id not in self.G.nodes:
             raise ValueError()
 
-        if destination.entity_id not in self.G.nodes:
+        if destination_id not in self.G.nodes:
             raise ValueError()
 
-        # TODO duplicate edges should not overwrite
+        if self.aggregate_edges:
+            existing = self.G.get_edge_data(source_id, destination_id, relation)
+
+            if existing:
+                edge = existing["obj"].aggregate(edge)
 
-        self.G.add_edge(
-            source.entity_id,
-            destination.entity_id,
-            relation,
-            obj=edge,
-            timestamp=timestamp,
-        )
+        self.G.add_edge(source_id, destination_id, relation, obj=edge)
+        self._time_index = None
 
     def combine(self, other: "Graph") -> "Graph":
         new = self
 
-        for _, n in other.G.nodes(data=True):
-            e: Entity = n["obj"]
-
+        for e in other.iter_entities():
             new.add_entity(e)
 
-        for u, v, r, data in other.G.edges(keys=True, data=True):
-            edge: Edge = data["obj"]
+        for edge in other.iter_edges():
+            new.add_edge(edge)
+
+        return new
+
+    def extend(self, newer: "Graph") -> "Graph":
+        # Merge a graph built from newer records. Existing entities and edges
+        # take precedence over the ones in `newer`
+        new = self
+
+        for e in newer.iter_entities():
+            entity_id = e.entity_id
+
+            if entity_id in new.G.nodes:
+                e = e.combine(new.G.nodes[entity_id]["obj"])
+
+            new.G.add_node(entity_id, obj=e)
+
+        for edge in newer.iter_edges():
+            if new.aggregate_edges:
+                new.add_edge(edge)
+                continue
+
+            if new.G.has_edge(edge.source_id, edge.destination_id, edge.relation):
+                continue
 
             new.add_edge(edge)
 
@@ -86,6 +131,54 @@ class Graph:
 
         return new
 
+    def window(self, start: float, end: float) -> "Graph":
+        # Edges with start <= timestamp < end, together with their endpoints.
+        # Aggregated edges are kept when [timestamp, last_timestamp] overlaps
+        # the window, but their count and timestamps still cover the whole log
+        timestamps, reach, keys = self._get_time_index()
+
+        lo = bisect_left(reach, start)
+        hi = bisect_left(timestamps, end)
+
+        new = Graph(self.aggregate_edges)
+
+        for u, v, r in keys[lo:hi]:
+            edge: Edge = self.G.edges[u, v, r]["obj"]
+
+            if edge.last_timestamp < start:
+                continue
+
+            for entity_id in (u, v):
+                if entity_id not in new.G.nodes:
+                    new.G.add_node(entity_id, obj=self.get_entity(entity_id))
+
+            new.G.add_edge(u, v, r, obj=edge)
+
+        return new
+
+    def _get_time_index(
+        self,
+    ) -> tuple[list[float], list[float], list[tuple[str, str, str]]]:
+        # Edge keys sorted by timestamp, with the running maximum of their last
+        # timestamps. Edges before the first reach >= start all end before
+        # start. Rebuilt lazily after the graph changes.
+        if self._time_index is None:
+            edges = sorted(
+                (
+                    (data["obj"].timestamp, data["obj"].last_timestamp, (u, v, r))
+                    for u, v, r, data in self.G.edges(keys=True, data=True)
+                ),
+                key=lambda e: e[0],
+            )
+
+            self._time_index = (
+                [t for t, _, _ in edges],
+                list(accumulate((last for _, last, _ in edges), max)),
+                [k for _, _, k in edges],
+            )
+
+        return self._time_index
+
     def trace(self, source_id: str) -> "Graph":
         prev_nodes: set = nx.ancestors(self.G, source_id)
         next_nodes: set = nx.descendants(self.G, source_id)
@@ -173,6 +266,9 @@ class Graph:
 
             edges.append(edge.to_prolog())
 
+            if self.aggregate_edges:
+                edges.append(edge.to_prolog_summary())
+
         entities.sort()
         edges.sort()
 
@@ -181,12 +277,17 @@ class Graph:
     def to_triples(
         self,
         include_timestamp=True,
-    ) -> list[tuple[str, str, str] | tuple[str, str, str, float]]:
+    ) -> list[tuple]:
         triples = []
 
-        for h, t, r, edge in self.G.edges(keys=True, data=True):
-            if include_timestamp:
-                triple = (h, r, t, edge["timestamp"])
+        for h, t, r, data in self.G.edges(keys=True, data=True):
+            edge: Edge = data["obj"]
+
+            if include_timestamp and self.aggregate_edges:
+                triple = (h, r, t, edge.timestamp, edge.last_timestamp, edge.count)
+
+            elif include_timestamp:
+                triple = (h, r, t, edge.timestamp)
 
             else:
                 triple = (h, r, t)
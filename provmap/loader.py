@@ -1,26 +1,47 @@
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from itertools import batched
+from typing import Iterable
 
 
 from provmap.events.event import Event
+from provmap.graph.csr_graph import CSRGraph
 from provmap.graph.graph import Graph
-from provmap.parsers import SysmonParser
+from provmap.parsers import SysmonJsonlParser, SysmonParser
 from provmap.parsers.parser import Parser
-from provmap.parsers.pcap import PcapParser
+from provmap.parsers.pcap import PcapParser, pcap_backend
 
 
 logger = logging.getLogger(__name__)
 
 LOG_PARSERS: dict[str, type[Parser]] = {
     "sysmon": SysmonParser,
+    "sysmon_jsonl": SysmonJsonlParser,
     "pcap": PcapParser,
 }
 
+GRAPH_BACKENDS: dict[str, type[Graph]] = {
+    "networkx": Graph,
+    "csr": CSRGraph,
+}
+
+# Bump when cached graph fragments can no longer be read by this version
+FRAGMENT_FORMAT_VERSION = 2
+
+# Parser options that only affect speed, not the graph, so they are left out
+# of fragment fingerprints
+UNFINGERPRINTED_PARSER_OPTIONS = {"workers"}
+
 
 class Loader:
     def __init__(self, config: dict) -> None:
         self.config = config
 
+        # Parser metrics of each log file parsed by this loader, by filepath
+        self.parser_metrics: dict[str, dict] = {}
+
         self.verify_config()
 
         logger.info(f"Loaded config [{self.config["name"]}]")
@@ -56,47 +77,275 @@ class Loader:
                 if not os.path.exists(log_filepath):
                     raise ValueError(f"Log {log_filepath} does not exist")
 
-    def events_to_graph(self, events: list[Event]) -> Graph:
-        graph = Graph()
+    @staticmethod
+    def events_to_graph(events: list[Event], graph: Graph | None = None) -> Graph:
+        graph = graph if graph is not None else Graph()
 
         # Older records have precedence
-        event_graphs = reversed([e.to_graph() for e in events])
-
-        for eg in event_graphs:
-            graph = graph.combine(eg)
+        for event in reversed(events):
+            event.add_to_graph(graph)
 
         return graph
 
-    def construct_graph(self, include_pcap: bool = False) -> Graph:
-        logger.info("Constructing graph")
-        graph = Graph()
+    @staticmethod
+    def stream_events_to_graph(
+        events: Iterable[Event], batch_size: int, graph: Graph | None = None
+    ) -> Graph:
+        graph = graph if graph is not None else Graph()
+        stream_graph = type(graph)(graph.aggregate_edges)
 
-        logs: dict[str, list[str]] = self.config["logs"]
+        # Batches arrive oldest first, so the graph built so far takes
+        # precedence over each new batch
+        for batch in batched(events, batch_size):
+            batch_graph = Graph(graph.aggregate_edges)
 
-        for log_type, log_files in logs.items():
-            logger.info(f"Found {len(log_files)} {log_type} file(s)")
-            parser = LOG_PARSERS[log_type]
+            stream_graph.extend(Loader.events_to_graph(list(batch), batch_graph))
 
-            for filepath in log_files:
-                logger.info(f"Parsing {log_type} file {filepath}")
+        if graph.number_of_entities == 0:
+            return stream_graph
 
-                if log_type == "pcap" and not include_pcap:
-                    logger.info("Skipping pcap file. Set --include-pcap to enable.")
-                    continue
+        return graph.combine(stream_graph)
 
-                complete_filepath = os.path.join(self.config["dir"], filepath)
+    def collect_log_files(self, include_pcap: bool = False) -> list[tuple[str, str]]:
+        log_files: list[tuple[str, str]] = []
 
-                events = parser(complete_filepath).parse()
-                # events = []
+        logs: dict[str, list[str]] = self.config["logs"]
 
-                logger.info(f"# of events = {len(events)}")
+        for log_type, filepaths in logs.items():
+            logger.info(f"Found {len(filepaths)} {log_type} file(s)")
 
-                event_graph = self.events_to_graph(events)
+            for filepath in filepaths:
+                if log_type == "pcap" and not include_pcap:
+                    logger.info(
+                        f"Skipping pcap file {filepath}. Set --include-pcap to enable."
+                    )
+                    continue
 
-                graph = graph.combine(event_graph)
+                complete_filepath = os.path.join(self.config["dir"], filepath)
+
+                log_files.append((log_type, complete_filepath))
+
+        return log_files
+
+    def construct_graph(
+        self,
+        include_pcap: bool = False,
+        workers: int = 1,
+        batch_size: int | None = None,
+        cache_dir: str | None = None,
+        backend: str = "networkx",
+        aggregate_edges: bool = False,
+        parser_options: dict[str, dict] | None = None,
+        refresh_cache: bool = False,
+    ) -> Graph:
+        logger.info(f"Constructing graph ({backend} backend)")
+        graph = GRAPH_BACKENDS[backend](aggregate_edges)
+
+        log_files = self.collect_log_files(include_pcap=include_pcap)
+
+        if cache_dir is None and (workers <= 1 or len(log_files) <= 1):
+            for log_type, filepath in log_files:
+                graph, metrics = parse_log_file(
+                    log_type, filepath, graph, batch_size, parser_options
+                )
+                self.parser_metrics[filepath] = metrics
+
+        else:
+            fragments = self.build_fragments(
+                log_files,
+                workers,
+                batch_size,
+                cache_dir,
+                backend,
+                aggregate_edges,
+                parser_options,
+                refresh_cache,
+            )
+
+            # Merge in config order so the result does not depend on which
+            # worker finishes first or which fragments were cached
+            for (log_type, filepath), fragment in zip(log_files, fragments):
+                logger.info(f"Merging {log_type} graph from {filepath}")
+                graph = graph.combine(fragment)
 
         logger.info(
             f"Graph construction complete (|V| = {graph.number_of_entities}, |E| = {graph.number_of_edges})"
         )
 
         return graph
+
+    def build_fragments(
+        self,
+        log_files: list[tuple[str, str]],
+        workers: int = 1,
+        batch_size: int | None = None,
+        cache_dir: str | None = None,
+        backend: str = "networkx",
+        aggregate_edges: bool = False,
+        parser_options: dict[str, dict] | None = None,
+        refresh_cache: bool = False,
+    ) -> list[Graph]:
+        graph_cls = GRAPH_BACKENDS[backend]
+        graph_kind = f"{backend}_aggregated" if aggregate_edges else backend
+
+        fragments: dict[int, Graph] = {}
+        fragment_filepaths: dict[int, str] = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            for i, (log_type, filepath) in enumerate(log_files):
+                fingerprint = log_file_fingerprint(log_type, filepath, parser_options)
+                fragment_filepath = os.path.join(
+                    cache_dir, f"{graph_kind}_{fingerprint}.pkl"
+                )
+                fragment_filepaths[i] = fragment_filepath
+
+                # Refreshing re-parses every file and overwrites its fragment,
+                # since fingerprints do not cover changes to the parsers
+                if refresh_cache or not os.path.exists(fragment_filepath):
+                    continue
+
+                logger.info(f"Loading cached {log_type} graph for {filepath}")
+
+                try:
+                    with open(fragment_filepath, "rb") as f:
+                        fragments[i] = graph_cls.from_pickle(f.read())
+
+                except Exception as e:
+                    logger.warning(f"Discarding unreadable cached graph: {e}")
+
+        pending = [i for i in range(len(log_files)) if i not in fragments]
+
+        if workers <= 1 or len(pending) <= 1:
+            for i in pending:
+                log_type, filepath = log_files[i]
+                fragments[i], metrics = parse_log_file(
+                    log_type,
+                    filepath,
+                    graph_cls(aggregate_edges),
+                    batch_size,
+                    parser_options,
+                )
+                self.parser_metrics[filepath] = metrics
+
+        else:
+            file_workers = min(workers, len(pending))
+            logger.info(f"Parsing {len(pending)} log files with {file_workers} workers")
+
+            # Parsers with their own pools share the budget of the file pool,
+            # so at most `workers` processes decode at any time
+            pool_options = cap_parser_workers(
+                parser_options, max(1, workers // file_workers)
+            )
+
+            with ProcessPoolExecutor(max_workers=file_workers) as executor:
+                futures = {
+                    i: executor.submit(
+                        parse_log_file,
+                        *log_files[i],
+                        graph_cls(aggregate_edges),
+                        batch_size,
+                        pool_options,
+                    )
+                    for i in pending
+                }
+
+                for i, future in futures.items():
+                    fragments[i], metrics = future.result()
+                    self.parser_metrics[log_files[i][1]] = metrics
+
+        for i in pending:
+            if i not in fragment_filepaths:
+                continue
+
+            logger.info(f"Caching graph for {log_files[i][1]}")
+
+            with open(fragment_filepaths[i], "wb") as f:
+                f.write(fragments[i].to_pickle())
+
+        return [fragments[i] for i in range(len(log_files))]
+
+
+def cap_parser_workers(
+    parser_options: dict[str, dict] | None, workers: int
+) -> dict[str, dict]:
+    return {
+        log_type: (
+            {**options, "workers": min(options["workers"], workers)}
+            if "workers" in options
+            else options
+        )
+        for log_type, options in (parser_options or {}).items()
+    }
+
+
+def parser_options_key(
+    log_type: str, parser_options: dict[str, dict] | None = None
+) -> str:
+    # Stable text of the options that change what a parser produces
+    options = dict((parser_options or {}).get(log_type, {}))
+
+    if log_type == "pcap":
+        # "auto" picks tshark only when it is installed, and the two readers
+        # differ on edge cases, so the reader it resolves to is keyed instead
+        options["backend"] = pcap_backend(options.get("backend", "auto"))
+
+    return repr(
+        sorted(
+            (k, v) for k, v in options.items() if k not in UNFINGERPRINTED_PARSER_OPTIONS
+        )
+    )
+
+
+def log_file_fingerprint(
+    log_type: str, filepath: str, parser_options: dict[str, dict] | None = None
+) -> str:
+    stat = os.stat(filepath)
+
+    key = [
+        f"v{FRAGMENT_FORMAT_VERSION}",
+        log_type,
+        os.path.abspath(filepath),
+        str(stat.st_size),
+        str(stat.st_mtime_ns),
+        parser_options_key(log_type, parser_options),
+    ]
+
+    h = sha256("\0".join(key).encode())
+
+    with open(filepath, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def parse_log_file(
+    log_type: str,
+    filepath: str,
+    graph: Graph | None = None,
+    batch_size: int | None = None,
+    parser_options: dict[str, dict] | None = None,
+) -> tuple[Graph, dict]:
+    logger.info(f"Parsing {log_type} file {filepath}")
+
+    options = (parser_options or {}).get(log_type, {})
+    parser = LOG_PARSERS[log_type](filepath, **options)
+
+    if batch_size:
+        logger.info(f"Streaming events in batches of {batch_size}")
+
+        graph = Loader.stream_events_to_graph(parser.iter_events(), batch_size, graph)
+
+    else:
+        events = parser.parse()
+
+        logger.info(f"# of events = {len(events)}")
+
+        graph = Loader.events_to_graph(events, graph)
+
+    parser.metrics.log(logger, filepath)
+
+    return graph, parser.metrics.as_dict()
+
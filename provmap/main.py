@@ -1,14 +1,25 @@
 import logging
+import math
 import os
+import time
+from datetime import datetime, timezone
 from functools import reduce
+from hashlib import sha256
+from typing import TYPE_CHECKING
 
 
+from provmap.datalog import DatalogReasoner
 from provmap.embedder import Embedder
-from provmap.loader import Loader
-from provmap.reasoner import Reasoner
+from provmap.loader import GRAPH_BACKENDS, LOG_PARSERS, Loader, parser_options_key
+from provmap.parsers.pcap import PCAP_BACKENDS
 from provmap.graph.graph import Graph
 import argparse
 
+# The Prolog reasoner loads pyswip on import, so it is only imported when
+# selected and the datalog backend runs without SWI-Prolog installed
+if TYPE_CHECKING:
+    from provmap.reasoner import Reasoner
+
 
 logger = logging.getLogger(__name__)
 logger.debug("Application start")
@@ -134,13 +145,13 @@ def save_graph_as_pickle(graph: Graph, outpath: str):
         f.write(pkl)
 
 
-def load_graph_from_pickle(inpath: str) -> Graph:
+def load_graph_from_pickle(inpath: str, graph_cls: type[Graph] = Graph) -> Graph:
     logger.info(f"Loading graph from pickle {inpath}")
 
     with open(inpath, "rb") as f:
         pkl = f.read()
 
-    return Graph.from_pickle(pkl)
+    return graph_cls.from_pickle(pkl)
 
 
 def save_embedder_as_pickle(embedder: Embedder, outpath: str):
@@ -161,21 +172,63 @@ def load_embedder_from_pickle(inpath: str) -> Embedder:
     return Embedder.from_pickle(pkl)
 
 
-def load_graph(config: dict, force_rebuild: bool = False, include_pcap: bool = False):
+def graph_pickle_filename(
+    backend: str = "networkx",
+    include_pcap: bool = False,
+    aggregate_edges: bool = False,
+    parser_options: dict[str, dict] | None = None,
+) -> str:
+    # Graphs built with different options are pickled side by side, so a
+    # cached graph is only reused for the options it was built with
+    key = [str(include_pcap)] + [
+        f"{log_type}={parser_options_key(log_type, parser_options)}"
+        for log_type in sorted(LOG_PARSERS)
+    ]
+    digest = sha256("\0".join(key).encode()).hexdigest()[:16]
+    graph_kind = f"{backend}_aggregated" if aggregate_edges else backend
+
+    return f"graph_{graph_kind}_{digest}.pkl"
+
+
+def load_graph(
+    config: dict,
+    force_rebuild: bool = False,
+    include_pcap: bool = False,
+    workers: int = 1,
+    batch_size: int | None = None,
+    use_fragment_cache: bool = True,
+    backend: str = "networkx",
+    aggregate_edges: bool = False,
+    parser_options: dict[str, dict] | None = None,
+):
     loader = Loader(config)
 
     outdir = config["outdir"]
+    pickle_filename = graph_pickle_filename(
+        backend, include_pcap, aggregate_edges, parser_options
+    )
 
     try:
         assert force_rebuild == False
-        pickle_inpath = os.path.join(outdir, "graph.pkl")
-        graph = load_graph_from_pickle(pickle_inpath)
+        pickle_inpath = os.path.join(outdir, pickle_filename)
+        graph = load_graph_from_pickle(pickle_inpath, GRAPH_BACKENDS[backend])
         logger.info(f"Loaded existing graph from {pickle_inpath}")
 
     except:
-        logger.info("Constructing graph from scratch")
+        logger.info("Constructing graph from log files")
 
-        graph: Graph = loader.construct_graph(include_pcap=include_pcap)
+        cache_dir = os.path.join(outdir, "fragments") if use_fragment_cache else None
+
+        graph: Graph = loader.construct_graph(
+            include_pcap=include_pcap,
+            workers=workers,
+            batch_size=batch_size,
+            cache_dir=cache_dir,
+            backend=backend,
+            aggregate_edges=aggregate_edges,
+            parser_options=parser_options,
+            refresh_cache=force_rebuild,
+        )
 
         outdir = config["outdir"]
         os.makedirs(outdir, exist_ok=True)
@@ -184,13 +237,16 @@ def load_graph(config: dict, force_rebuild: bool = False, include_pcap: bool = F
         save_graph_as_prolog(graph, os.path.join(outdir, "graph.pl"))
         save_graph_as_triples(graph, os.path.join(outdir, "graph.txt"))
 
-        save_graph_as_pickle(graph, os.path.join(outdir, "graph.pkl"))
+        save_graph_as_pickle(graph, os.path.join(outdir, pickle_filename))
 
     return graph
 
 
 def load_embedder(
-    config: dict, graph: Graph, reasoner: Reasoner | None, force_retrain=False
+    config: dict,
+    graph: Graph,
+    reasoner: "Reasoner | DatalogReasoner | None",
+    force_retrain=False,
 ) -> Embedder:
     outdir = config["outdir"]
 
@@ -264,6 +320,15 @@ def load_from_provcon(scenario: str, date: str, time: str) -> dict:
     }
 
 
+def parse_utc_timestamp(value: str) -> float:
+    dt = datetime.fromisoformat(value)
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt.timestamp()
+
+
 def main():
     parser = argparse.ArgumentParser(description="provmap")
     parser.add_argument(
@@ -272,11 +337,94 @@ def main():
     parser.add_argument("--date", type=str, required=True, help="Date (YYYY-MM-DD)")
     parser.add_argument("--time", type=str, required=True, help="Time (HHMM)")
     parser.add_argument(
-        "--force-rebuild", action="store_true", help="Force rebuild of the graph"
+        "--force-rebuild",
+        action="store_true",
+        help="Re-parse every log file and overwrite the cached graph and per-file graphs",
     )
     parser.add_argument(
         "--include-pcap", action="store_true", help="Include packet captures in graph"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to parse log files",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Stream events into the graph in batches of this size",
+    )
+    parser.add_argument(
+        "--no-fragment-cache",
+        action="store_true",
+        help="Neither read nor write cached per-file graphs (--force-rebuild refreshes them instead)",
+    )
+    parser.add_argument(
+        "--no-prolog-cache",
+        action="store_true",
+        help="Consult rules and facts as Prolog text instead of reusing cached QLF files",
+    )
+    parser.add_argument(
+        "--no-tabling",
+        action="store_true",
+        help="Evaluate recursive rules without SWI-Prolog tabling",
+    )
+    parser.add_argument(
+        "--graph-backend",
+        choices=list(GRAPH_BACKENDS.keys()),
+        default="networkx",
+        help="Graph storage backend",
+    )
+    parser.add_argument(
+        "--aggregate-edges",
+        action="store_true",
+        help="Merge repeated edges, keeping a count and first/last timestamps",
+    )
+    parser.add_argument(
+        "--sysmon-event-ids",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Only decode Sysmon records with these EventIDs (default: all supported)",
+    )
+    parser.add_argument(
+        "--sysmon-workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to decode each Sysmon log file",
+    )
+    parser.add_argument(
+        "--pcap-backend",
+        choices=list(PCAP_BACKENDS),
+        default="auto",
+        help="Packet capture reader (auto: tshark if installed, else native)",
+    )
+    parser.add_argument(
+        "--pcap-workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to decode slices of each packet capture",
+    )
+    parser.add_argument(
+        "--reasoner",
+        choices=["prolog", "datalog"],
+        default="prolog",
+        help="Evaluate the detection rules with SWI-Prolog or the built-in datalog engine",
+    )
+    parser.add_argument(
+        "--window-start",
+        type=parse_utc_timestamp,
+        default=None,
+        help="Only reason over edges at or after this ISO-8601 time (UTC)",
+    )
+    parser.add_argument(
+        "--window-end",
+        type=parse_utc_timestamp,
+        default=None,
+        help="Only reason over edges before this ISO-8601 time (UTC)",
+    )
 
     args = parser.parse_args()
 
@@ -284,23 +432,74 @@ def main():
 
     config = load_from_provcon(args.scenario, args.date, args.time)
     outdir = config["outdir"]
+
+    sysmon_options: dict = {"workers": args.sysmon_workers}
+
+    if args.sysmon_event_ids is not None:
+        sysmon_options["event_ids"] = sorted(set(args.sysmon_event_ids))
+
+    parser_options = {
+        "sysmon": sysmon_options,
+        "sysmon_jsonl": sysmon_options,
+        "pcap": {"backend": args.pcap_backend, "workers": args.pcap_workers},
+    }
+
     graph = load_graph(
         config,
         force_rebuild=args.force_rebuild,
         include_pcap=args.include_pcap,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        use_fragment_cache=not args.no_fragment_cache,
+        backend=args.graph_backend,
+        aggregate_edges=args.aggregate_edges,
+        parser_options=parser_options,
     )
 
-    reasoner = Reasoner(graph, "rules/schema.pl", "rules/rules.pl")
+    if args.window_start is not None or args.window_end is not None:
+        start = args.window_start if args.window_start is not None else -math.inf
+        end = args.window_end if args.window_end is not None else math.inf
+
+        graph = graph.window(start, end)
+        logger.info(f"Restricted graph to time window: {graph}")
+
+        if args.aggregate_edges:
+            logger.warning(
+                "Aggregated edges overlapping the time window keep the counts and timestamps of the whole log"
+            )
+
+    started = time.perf_counter()
+
+    if args.reasoner == "datalog":
+        reasoner = DatalogReasoner(graph, "rules/schema.pl", "rules/rules.pl")
+
+    else:
+        from provmap.reasoner import TABLED_PREDICATES, Reasoner
+
+        reasoner = Reasoner(
+            graph,
+            "rules/schema.pl",
+            "rules/rules.pl",
+            cache_dir=(
+                None if args.no_prolog_cache else os.path.join(outdir, "prolog")
+            ),
+            tabled=() if args.no_tabling else TABLED_PREDICATES,
+        )
 
     malicious_entities = reasoner.get_malicious_entities()
     malicious_graph = graph.subgraph(malicious_entities)
 
     save_graph_as_graphviz(malicious_graph, os.path.join(outdir, "malicious_graph.gv"))
 
-    for entity_id in malicious_graph.G.nodes():
-        tags = reasoner.get_tags(malicious_graph.get_entity(entity_id))
+    all_tags = reasoner.get_all_tags(malicious_graph.iter_entities())
+
+    for entity_id, tags in all_tags.items():
         logger.info(f"Tags for {entity_id}: \n{"\n".join(tags)}")
 
+    logger.info(
+        f"Reasoning took {time.perf_counter() - started:.2f}s ({args.reasoner} reasoner)"
+    )
+
     exit()
 
     # terminals = malicious_graph.get_leaves()
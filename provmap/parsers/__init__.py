@@ -1 +1 @@
-from provmap.parsers.sysmon import SysmonParser
\ No newline at end of file
+from provmap.parsers.sysmon import SysmonJsonlParser, SysmonParser
\ No newline at end of file
@@ -0,0 +1,214 @@
+import re
+
+
+from Evtx.Evtx import ChunkHeader, Record
+from Evtx.Nodes import (
+    AttributeNode,
+    BXmlTypeNode,
+    ConditionalSubstitutionNode,
+    NormalSubstitutionNode,
+    OpenStartElementNode,
+    ValueNode,
+)
+
+
+# Characters dropped by python-evtx when rendering XML. Only the ASCII ones
+# matter, the rest are written as character references and survive.
+RESTRICTED_CHARS = re.compile("[\x01-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+SUBSTITUTION_NODES = (NormalSubstitutionNode, ConditionalSubstitutionNode)
+
+# Text content of an element, as literal strings and substitution indices
+Pieces = tuple[str | int, ...]
+
+
+class UnsupportedTemplate(Exception):
+    pass
+
+
+class EvtxTemplate:
+    def __init__(
+        self,
+        event_id: Pieces | None,
+        fields: list[tuple[str, Pieces]],
+        embedded: list[int],
+    ) -> None:
+        self.event_id = event_id
+        self.fields = fields
+        # Substitutions directly under Event, which hold EventData as nested
+        # BinXML in Sysmon logs
+        self.embedded = embedded
+
+
+def element_pieces(element: OpenStartElementNode) -> Pieces:
+    pieces: list[str | int] = []
+
+    for child in element.children():
+        if isinstance(child, ValueNode):
+            pieces.append(child.value().string())
+
+        elif isinstance(child, SUBSTITUTION_NODES):
+            pieces.append(child.index())
+
+        elif isinstance(child, OpenStartElementNode):
+            raise UnsupportedTemplate("Nested element in value")
+
+    return tuple(pieces)
+
+
+def element_name_attribute(element: OpenStartElementNode) -> str:
+    for child in element.children():
+        if not isinstance(child, AttributeNode):
+            continue
+
+        if child.attribute_name().string() != "Name":
+            continue
+
+        value = child.attribute_value()
+
+        if not isinstance(value, ValueNode):
+            raise UnsupportedTemplate("Substituted Name attribute")
+
+        return value.value().string()
+
+    raise UnsupportedTemplate("Data element without Name attribute")
+
+
+def compile_template(root, parent_tag: str | None = None) -> EvtxTemplate:
+    event_id: Pieces | None = None
+    fields: list[tuple[str, Pieces]] = []
+    embedded: list[int] = []
+
+    def walk(node, parent_tag: str | None) -> None:
+        nonlocal event_id
+
+        for child in node.children():
+            if isinstance(child, SUBSTITUTION_NODES) and parent_tag == "Event":
+                embedded.append(child.index())
+                continue
+
+            if not isinstance(child, OpenStartElementNode):
+                continue
+
+            tag = child.tag_name()
+
+            if tag == "EventID" and parent_tag == "System":
+                event_id = element_pieces(child)
+
+            elif tag == "Data" and parent_tag == "EventData":
+                fields.append((element_name_attribute(child), element_pieces(child)))
+
+            else:
+                walk(child, tag)
+
+    walk(root.template(), parent_tag)
+
+    return EvtxTemplate(event_id, fields, embedded)
+
+
+def substitute(pieces: Pieces, substitutions: list) -> str:
+    values = []
+
+    for piece in pieces:
+        if isinstance(piece, str):
+            values.append(piece)
+            continue
+
+        sub = substitutions[piece]
+
+        if isinstance(sub, BXmlTypeNode):
+            raise UnsupportedTemplate("Embedded BinXML substitution")
+
+        values.append(sub.string())
+
+    # Mirror XML rendering followed by xmltodict: restricted characters are
+    # dropped, line endings normalised and surrounding whitespace stripped
+    value = RESTRICTED_CHARS.sub("", "".join(values))
+
+    return value.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
+def template_key(root) -> int:
+    return root.template_instance().template_offset()
+
+
+def cached_template(root, templates: dict, parent_tag: str | None) -> EvtxTemplate:
+    key = template_key(root)
+
+    if key not in templates:
+        try:
+            templates[key] = compile_template(root, parent_tag)
+
+        except UnsupportedTemplate:
+            templates[key] = None
+
+    template = templates[key]
+
+    if template is None:
+        raise UnsupportedTemplate("Template could not be compiled")
+
+    return template
+
+
+def collect_event_data(
+    template: EvtxTemplate, substitutions: list, templates: dict, event_data: dict
+) -> None:
+    for name, pieces in template.fields:
+        event_data[name] = substitute(pieces, substitutions)
+
+    for index in template.embedded:
+        sub = substitutions[index]
+
+        if not isinstance(sub, BXmlTypeNode):
+            continue
+
+        root = sub.root()
+        embedded = cached_template(root, templates, "Event")
+
+        collect_event_data(embedded, root.substitutions(), templates, event_data)
+
+
+def record_to_dict(
+    record: Record, templates: dict, event_ids: frozenset[int] | None = None
+) -> dict:
+    root = record.root()
+    template = cached_template(root, templates, None)
+
+    if template.event_id is None:
+        raise UnsupportedTemplate("No EventID")
+
+    substitutions = root.substitutions()
+
+    event_id = int(substitute(template.event_id, substitutions))
+
+    # Skip the embedded EventData of records nobody asked for, reporting
+    # just the EventID so they can still be counted
+    if event_ids is not None and event_id not in event_ids:
+        return {"EventID": event_id}
+
+    event_data: dict[str, str] = {}
+    collect_event_data(template, substitutions, templates, event_data)
+
+    if not event_data:
+        raise UnsupportedTemplate("No EventData")
+
+    return {
+        "EventID": event_id,
+        "EventData": event_data,
+    }
+
+
+def chunk_to_dicts(
+    chunk: ChunkHeader, fallback, event_ids: frozenset[int] | None = None
+):
+    # Templates, including those of embedded EventData, are addressed by
+    # their offset within the chunk, so the cache is only valid for the chunk
+    # it was built from
+    templates: dict[int, EvtxTemplate | None] = {}
+
+    for record in chunk.records():
+        try:
+            yield record_to_dict(record, templates, event_ids)
+
+        except UnsupportedTemplate:
+            yield fallback(record)
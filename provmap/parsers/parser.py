@@ -1,9 +1,93 @@
+import logging
+import time
+from collections import Counter
+from typing import Iterator
+
 from provmap.events.event import Event
 
+
+class ParserMetrics:
+    def __init__(self) -> None:
+        self.records_read: int = 0
+        self.bytes_read: int = 0
+        self.records_kept: Counter = Counter()
+        self.records_dropped: Counter = Counter()
+        self.parse_failures: Counter = Counter()
+        self._started: float | None = None
+        self._elapsed: float = 0.0
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+
+    def stop(self) -> None:
+        if self._started is not None:
+            self._elapsed += time.perf_counter() - self._started
+            self._started = None
+
+    def read(self, records: int = 1) -> None:
+        self.records_read += records
+
+    def keep(self, key) -> None:
+        self.records_kept[str(key)] += 1
+
+    def drop(self, reason: str, records: int = 1) -> None:
+        self.records_dropped[reason] += records
+
+    def fail(self, error: Exception, field: str | None = None) -> None:
+        key = type(error).__name__ if field is None else f"{type(error).__name__}:{field}"
+
+        self.parse_failures[key] += 1
+        self.drop("parse_failure")
+
+    @property
+    def elapsed(self) -> float:
+        if self._started is None:
+            return self._elapsed
+
+        return self._elapsed + time.perf_counter() - self._started
+
+    def as_dict(self) -> dict:
+        elapsed = self.elapsed
+
+        return {
+            "records_read": self.records_read,
+            "records_kept": dict(self.records_kept),
+            "records_dropped": dict(self.records_dropped),
+            "parse_failures": dict(self.parse_failures),
+            "bytes_read": self.bytes_read,
+            "elapsed_seconds": elapsed,
+            "records_per_second": self.records_read / elapsed if elapsed else 0.0,
+            "bytes_per_second": self.bytes_read / elapsed if elapsed else 0.0,
+        }
+
+    def log(self, logger: logging.Logger, name: str) -> None:
+        m = self.as_dict()
+
+        logger.info(
+            f"Parsed {name}: {m["records_read"]} records read, "
+            f"{sum(self.records_kept.values())} kept, "
+            f"{sum(self.records_dropped.values())} dropped in {m["elapsed_seconds"]:.2f}s "
+            f"({m["records_per_second"]:.0f} records/s, {m["bytes_per_second"] / 2**20:.1f} MiB/s)"
+        )
+
+        if self.records_kept:
+            logger.info(f"Kept records: {dict(self.records_kept)}")
+
+        if self.records_dropped:
+            logger.info(f"Dropped records: {dict(self.records_dropped)}")
+
+        if self.parse_failures:
+            logger.info(f"Parse failures: {dict(self.parse_failures)}")
+
+
 class Parser:
+    metrics: ParserMetrics
+
     def __init__(self, filepath: str, *args, **kwargs) -> None:
         raise NotImplementedError()
     
     def parse(self, *args, **kwargs) -> list[Event]:
         raise NotImplementedError()
 
+    def iter_events(self, *args, **kwargs) -> Iterator[Event]:
+        raise NotImplementedError()
@@ -1,50 +1,227 @@
+import mmap
 import os
-
-
-import pyshark
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
 
 
 from provmap.events.event import Event
 from provmap.events import pcap
-from provmap.parsers.parser import Parser
+from provmap.parsers.parser import Parser, ParserMetrics
+from provmap.parsers.pcapfile import (
+    CaptureSlice,
+    PcapPacket,
+    pcapfile_slices,
+    pcapfile_to_packets,
+)
 
 
 PCAP_DISPLAY_FILTERS = "(http.request or http.response) or ftp"
 
-
-def pcap_to_packets(pcap_filepath: str):
-    cap = pyshark.FileCapture(
+TSHARK_PATH = os.getenv("TSHARK_PATH", "tshark")
+
+# "auto" uses tshark when it is installed and the built-in reader otherwise
+PCAP_BACKENDS = ("auto", "tshark", "native")
+
+# Captures are split into slices of this many packets when read by several
+# workers. Each slice also reads the packets just before it, so TCP streams
+# and HTTP requests that cross the boundary are seen whole.
+PCAP_PACKETS_PER_SLICE = 1 << 17
+PCAP_SLICE_OVERLAP = 1 << 11
+
+SLICE_COPY_BYTES = 1 << 20
+
+
+# tshark fields extracted for each packet, in PcapPacket order
+TSHARK_FIELDS = (
+    "frame.time_epoch",
+    "frame.protocols",
+    "ip.src",
+    "ip.dst",
+    "ipv6.src",
+    "ipv6.dst",
+    "tcp.srcport",
+    "tcp.dstport",
+    "udp.srcport",
+    "udp.dstport",
+    "http.request",
+    "http.response",
+    "http.request.method",
+    "http.response.code",
+    "http.request.full_uri",
+    "ftp.request",
+    "ftp.request.command",
+    "ftp.request.arg",
+    "ftp.response.code",
+    "ftp.response.arg",
+)
+
+TSHARK_TRUE = ("1", "True")
+
+# (client ip, client port, server ip, server port)
+Flow = tuple[str, str, str, str]
+
+
+def tshark_command(pcap_filepath: str, skip: int = 0) -> list[str]:
+    display_filter = PCAP_DISPLAY_FILTERS
+
+    if skip:
+        display_filter = f"({display_filter}) and frame.number > {skip}"
+
+    command = [
+        TSHARK_PATH,
+        "-r",
         pcap_filepath,
-        keep_packets=False,
-        display_filter=PCAP_DISPLAY_FILTERS,
-        custom_parameters={
-            "-j": "ip tcp udp http ftp",
-            "-o": "http.desegment_body:FALSE",
-        },
-    )
+        "-n",
+        "-Y",
+        display_filter,
+        "-o",
+        "http.desegment_body:FALSE",
+        "-T",
+        "fields",
+        "-E",
+        "separator=/t",
+        "-E",
+        "occurrence=f",
+        "-E",
+        "quote=n",
+    ]
+
+    for field in TSHARK_FIELDS:
+        command.extend(["-e", field])
+
+    return command
+
+
+def tshark_to_packets(pcap_filepath: str, skip: int = 0) -> Iterator[PcapPacket]:
+    # A single tshark process prints only the fields we read, one packet
+    # per line. tshark escapes control characters in field values, so
+    # splitting on tabs is safe.
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            tshark_command(pcap_filepath, skip),
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            text=True,
+            bufsize=1 << 16,
+        )
+
+        try:
+            for line in proc.stdout:
+                values = line.rstrip("\n").split("\t")
+
+                if len(values) != len(TSHARK_FIELDS):
+                    raise ValueError(f"Unexpected tshark output: {line!r}")
+
+                yield PcapPacket(*values)
+
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+
+            proc.stdout.close()
+            returncode = proc.wait()
+
+        if returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors="replace").strip()
+
+            raise RuntimeError(f"tshark failed on {pcap_filepath}: {message}")
+
+
+def pcap_backend(backend: str) -> str:
+    if backend == "auto":
+        return "tshark" if shutil.which(TSHARK_PATH) else "native"
+
+    return backend
+
+
+def pcap_to_packets(pcap_filepath: str, backend: str = "auto") -> Iterator[PcapPacket]:
+    if pcap_backend(backend) == "tshark":
+        return tshark_to_packets(pcap_filepath)
+
+    return pcapfile_to_packets(pcap_filepath)
+
 
-    for pkt in cap:
-        yield pkt
+def pcap_slice_to_packets(
+    pcap_filepath: str, capture_slice: CaptureSlice, backend: str
+) -> list[PcapPacket]:
+    if backend != "tshark":
+        return list(pcapfile_to_packets(pcap_filepath, capture_slice))
 
-    cap.close()
+    # tshark only reads files, so the slice is copied out behind its headers
+    suffix = os.path.splitext(pcap_filepath)[1]
 
+    with tempfile.NamedTemporaryFile(suffix=suffix) as slice_file:
+        slice_file.write(capture_slice.preamble)
 
-def parse_ip(pkt) -> tuple[str, str]:
-    return (pkt.ip.src, pkt.ip.dst)
+        with open(pcap_filepath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for offset in range(
+                    capture_slice.begin, capture_slice.end, SLICE_COPY_BYTES
+                ):
+                    slice_file.write(
+                        buf[offset : min(offset + SLICE_COPY_BYTES, capture_slice.end)]
+                    )
 
+        slice_file.flush()
 
-def parse_tcp(pkt) -> tuple[int, int]:
-    return (pkt.tcp.srcport, pkt.tcp.dstport)
+        return list(tshark_to_packets(slice_file.name, capture_slice.skip))
 
 
-def parse_udp(pkt) -> tuple[int, int]:
-    return (pkt.udp.srcport, pkt.udp.dstport)
+def ordered_parallel_slices(
+    pcap_filepath: str, slices: list[CaptureSlice], backend: str, workers: int
+) -> Iterator[tuple[int, list[PcapPacket]]]:
+    # At most 2 * workers slices are in flight, so at most that many tshark
+    # processes and decoded slices exist at once. Results come back in
+    # capture order.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
 
+        for i, capture_slice in enumerate(slices):
+            pending.append(
+                (
+                    i,
+                    executor.submit(
+                        pcap_slice_to_packets, pcap_filepath, capture_slice, backend
+                    ),
+                )
+            )
 
-def parse_l3_l4(pkt) -> tuple[str, int, str, int]:
+            if len(pending) >= 2 * workers:
+                i, future = pending.popleft()
+                yield i, future.result()
+
+        while pending:
+            i, future = pending.popleft()
+            yield i, future.result()
+
+
+def parse_ip(pkt: PcapPacket) -> tuple[str, str]:
+    if pkt.ip_src:
+        return (pkt.ip_src, pkt.ip_dst)
+
+    if pkt.ipv6_src:
+        return (pkt.ipv6_src, pkt.ipv6_dst)
+
+    raise AttributeError("No IP layer")
+
+
+def parse_tcp(pkt: PcapPacket) -> tuple[str, str]:
+    return (pkt.tcp_srcport, pkt.tcp_dstport)
+
+
+def parse_udp(pkt: PcapPacket) -> tuple[str, str]:
+    return (pkt.udp_srcport, pkt.udp_dstport)
+
+
+def parse_l3_l4(pkt: PcapPacket) -> tuple[str, str, str, str]:
     source_ip, destination_ip = parse_ip(pkt)
     source_port, destination_port = (
-        parse_tcp(pkt) if "TCP" in str(pkt.layers) else parse_udp(pkt)
+        parse_tcp(pkt) if "tcp" in pkt.layers else parse_udp(pkt)
     )
 
     return (
@@ -55,34 +232,34 @@ def parse_l3_l4(pkt) -> tuple[str, int, str, int]:
     )
 
 
-def parse_http(pkt) -> tuple[str | int, str]:
-    http = pkt.http
-
-    uri = http.request_full_uri
-
-    top_line: str = getattr(http, "").strip().replace("\\r\\n", "")
+def parse_http(pkt: PcapPacket) -> tuple[str | int, str]:
+    uri = pkt.http_request_full_uri
 
-    if "request" in http.field_names:
-        request_method, _, _ = top_line.split(" ", maxsplit=2)
+    if not uri:
+        raise AttributeError("No request_full_uri field")
 
-        return (request_method, uri)
+    if pkt.http_request in TSHARK_TRUE:
+        return (pkt.http_request_method, uri)
 
-    elif "response" in http.field_names:
-        _, response_code, _ = top_line.split(" ", maxsplit=2)
-        return (int(response_code), uri)
+    elif pkt.http_response in TSHARK_TRUE:
+        return (int(pkt.http_response_code), uri)
 
     else:
         raise ValueError("Could not parse HTTP layer")
 
 
-def parse_http_transaction(req, res) -> pcap.HttpTransaction:
+def parse_http_transaction(
+    req: PcapPacket,
+    res: PcapPacket,
+    flow: Flow,
+    request_method: str,
+    uri: str,
+    response_code: int,
+) -> pcap.HttpTransaction:
     request_timestamp = float(req.sniff_timestamp)
     response_timestamp = float(res.sniff_timestamp)
 
-    client_ip, client_port, server_ip, server_port = parse_l3_l4(req)
-
-    request_method, uri = parse_http(req)
-    response_code, _ = parse_http(res)
+    client_ip, client_port, server_ip, server_port = flow
 
     return pcap.HttpTransaction(
         request_timestamp=request_timestamp,
@@ -97,13 +274,18 @@ def parse_http_transaction(req, res) -> pcap.HttpTransaction:
     )
 
 
-def parse_ftp(pkt) -> tuple[str | int, str]:
-    ftp = pkt.ftp
+def parse_ftp(pkt: PcapPacket) -> tuple[str | int, str]:
+    is_request = pkt.ftp_request in TSHARK_TRUE
 
-    top_line: str = getattr(ftp, "").replace("\\r\\n", "")
-    args = top_line.split(" ", maxsplit=1)
+    # The first line of the PDU, rebuilt from its dissected parts
+    if is_request:
+        parts = (pkt.ftp_request_command, pkt.ftp_request_arg)
+
+    else:
+        parts = (pkt.ftp_response_code, pkt.ftp_response_arg)
 
-    is_request = ftp.request.lower() == "true"
+    top_line = " ".join(part for part in parts if part)
+    args = top_line.split(" ", maxsplit=1)
 
     if len(args) == 1:
         args = top_line.split("-", maxsplit=1)
@@ -122,14 +304,18 @@ def parse_ftp(pkt) -> tuple[str | int, str]:
         return (int(ftp_arg1 if ftp_arg1 else 0), ftp_arg2)
 
 
-def parse_ftp_transaction(req, res) -> pcap.FtpTransaction:
+def parse_ftp_transaction(
+    req: PcapPacket,
+    res: PcapPacket,
+    flow: Flow,
+    command: str,
+    arg: str,
+    response_code: int,
+) -> pcap.FtpTransaction:
     request_timestamp = float(req.sniff_timestamp)
     response_timestamp = float(res.sniff_timestamp)
 
-    client_ip, client_port, server_ip, server_port = parse_l3_l4(req)
-
-    command, arg = parse_ftp(req)
-    response_code, _ = parse_ftp(res)
+    client_ip, client_port, server_ip, server_port = flow
 
     return pcap.FtpTransaction(
         request_timestamp=request_timestamp,
@@ -144,120 +330,204 @@ def parse_ftp_transaction(req, res) -> pcap.FtpTransaction:
     )
 
 
-def is_request_response(req, res) -> bool:
-    (
-        req_source_ip,
-        req_source_port,
-        req_destination_ip,
-        req_destination_port,
-    ) = parse_l3_l4(req)
-
-    (
-        res_source_ip,
-        res_source_port,
-        res_destination_ip,
-        res_destination_port,
-    ) = parse_l3_l4(res)
-
-    return all(
-        [
-            req_source_ip == res_destination_ip,
-            req_source_port == res_destination_port,
-            req_destination_ip == res_source_ip,
-            req_destination_port == res_source_port,
-        ]
-    )
+# Pairs each response with the oldest unanswered request on its flow, so
+# pipelined requests and interleaved connections are matched correctly
+class FlowMatcher:
+    def __init__(self) -> None:
+        self.pending: dict[Flow, deque[tuple[PcapPacket, str, str]]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self.pending.values())
+
+    def add_request(self, pkt: PcapPacket, flow: Flow, x: str, y: str) -> None:
+        self.pending.setdefault(flow, deque()).append((pkt, x, y))
+
+    def oldest_request(self, flow: Flow) -> tuple[PcapPacket, str, str] | None:
+        q = self.pending.get(flow)
+
+        return q[0] if q else None
+
+    def match_response(self, flow: Flow) -> tuple[PcapPacket, str, str] | None:
+        q = self.pending.get(flow)
+
+        if not q:
+            return None
+
+        request = q.popleft()
+
+        if not q:
+            del self.pending[flow]
+
+        return request
 
 
 class PcapParser(Parser):
-    def __init__(self, filepath: str) -> None:
+    def __init__(self, filepath: str, backend: str = "auto", workers: int = 1) -> None:
+        if backend not in PCAP_BACKENDS:
+            raise ValueError(
+                f"Unknown pcap backend '{backend}'. Valid backends are {list(PCAP_BACKENDS)}"
+            )
+
         self.filepath = filepath
+        self.backend = backend
+        self.workers = workers
+        self.metrics = ParserMetrics()
         self._parsed: bool = False
         self._events: list[Event] = []
-        self._http_packets = []
-        self._ftp_packets = []
 
     def parse(self) -> list[Event]:
         if self._parsed:
             return self._events
 
-        self._http_packets = []
-        self._ftp_packets = []
+        self._events = list(self.iter_events())
 
-        packets = pcap_to_packets(self.filepath)
+        self._parsed = True
+        return self._events
 
-        for pkt in packets:
-            http = getattr(pkt, "http", None)
+    def iter_packets(self) -> Iterator[tuple[bool, PcapPacket]]:
+        # Packets, and whether they came from a slice after the first, where
+        # a response may answer a request the slice did not see
+        backend = pcap_backend(self.backend)
 
-            if http:
-                self._http_packets.append(pkt)
+        if self.workers > 1:
+            slices = pcapfile_slices(
+                self.filepath, PCAP_PACKETS_PER_SLICE, PCAP_SLICE_OVERLAP
+            )
 
-                continue
+            if len(slices) > 1:
+                for i, packets in ordered_parallel_slices(
+                    self.filepath, slices, backend, self.workers
+                ):
+                    for pkt in packets:
+                        yield i > 0, pkt
 
-            ftp = getattr(pkt, "ftp", None)
+                return
 
-            if ftp:
-                self._ftp_packets.append(pkt)
+        for pkt in pcap_to_packets(self.filepath, backend):
+            yield False, pkt
 
-                continue
+    def iter_events(self) -> Iterator[Event]:
+        http_q = FlowMatcher()
+        ftp_q = FlowMatcher()
 
-        q = []
-        for pkt in self._http_packets:
-            try:
-                x, uri = parse_http(pkt)
-            except:
-                continue
+        self.metrics.bytes_read += os.path.getsize(self.filepath)
+        self.metrics.start()
 
-            if type(x) == str:
-                q.append(pkt)
+        try:
+            for sliced, pkt in self.iter_packets():
+                self.metrics.read()
 
-            elif type(x) == int:
-                if len(q) == 0:  # No matching request packet
-                    continue
+                event = None
 
-                res = pkt
-                req = q.pop(0)
+                layers = pkt.layers
+                http = "http" in layers
+                ftp = "ftp" in layers and not http
 
-                if not is_request_response(req, res):
-                    continue
+                if http:
+                    if sliced:
+                        pkt = self._stitch_response(pkt, http_q)
 
-                _, req_uri = parse_http(req)
+                    event = self._match_http(pkt, http_q)
 
-                if req_uri == uri:
-                    event = parse_http_transaction(req, res)
-                    self._events.append(event)
+                elif ftp:
+                    event = self._match_ftp(pkt, ftp_q)
 
-        q = []
-        for pkt in self._ftp_packets:
-            try:
-                x, _ = parse_ftp(pkt)
-            except:
-                continue
+                else:
+                    self.metrics.drop("not_http_or_ftp")
 
-            if type(x) == str:
-                q.append(pkt)
+                if event:
+                    self.metrics.keep("http" if http else "ftp")
 
-            elif type(x) == int:
-                if len(q) == 0:  # No matching request packet
-                    continue
+                    # Time spent by the consumer is not parse time
+                    self.metrics.stop()
+                    yield event
+                    self.metrics.start()
 
-                res = pkt
-                req = q.pop(0)
+            if http_q or ftp_q:
+                self.metrics.drop("unanswered_request", len(http_q) + len(ftp_q))
 
-                if not is_request_response(req, res):
-                    continue
+        finally:
+            self.metrics.stop()
 
-                command, arg = parse_ftp(req)
-                response_code, _ = parse_ftp(res)
+    def _stitch_response(self, pkt: PcapPacket, q: FlowMatcher) -> PcapPacket:
+        # A response whose request was before its slice has no URI, which
+        # the request still waiting on its flow provides
+        if pkt.http_response not in TSHARK_TRUE or pkt.http_request_full_uri:
+            return pkt
 
-                if response_code == 0:
-                    continue
+        try:
+            source_ip, source_port, destination_ip, destination_port = parse_l3_l4(pkt)
+        except Exception:
+            return pkt
 
-                if arg == "":
-                    continue
+        request = q.oldest_request(
+            (destination_ip, destination_port, source_ip, source_port)
+        )
 
-                event = parse_ftp_transaction(req, res)
-                self._events.append(event)
+        if request is None:
+            return pkt
 
-        self._parsed = True
-        return self._events
+        return pkt._replace(http_request_full_uri=request[2])
+
+    def _match_http(self, pkt: PcapPacket, q: FlowMatcher) -> pcap.HttpTransaction | None:
+        try:
+            x, uri = parse_http(pkt)
+            source_ip, source_port, destination_ip, destination_port = parse_l3_l4(pkt)
+        except Exception as e:
+            self.metrics.fail(e, "http")
+            return None
+
+        if type(x) == str:
+            flow = (source_ip, source_port, destination_ip, destination_port)
+            q.add_request(pkt, flow, x, uri)
+
+        elif type(x) == int:
+            flow = (destination_ip, destination_port, source_ip, source_port)
+            request = q.match_response(flow)
+
+            if request is None:  # No matching request packet
+                self.metrics.drop("response_without_request")
+                return None
+
+            req, request_method, req_uri = request
+
+            if req_uri == uri:
+                return parse_http_transaction(req, pkt, flow, request_method, uri, x)
+
+            self.metrics.drop("uri_mismatch")
+
+        return None
+
+    def _match_ftp(self, pkt: PcapPacket, q: FlowMatcher) -> pcap.FtpTransaction | None:
+        try:
+            x, arg = parse_ftp(pkt)
+            source_ip, source_port, destination_ip, destination_port = parse_l3_l4(pkt)
+        except Exception as e:
+            self.metrics.fail(e, "ftp")
+            return None
+
+        if type(x) == str:
+            flow = (source_ip, source_port, destination_ip, destination_port)
+            q.add_request(pkt, flow, x, arg)
+
+        elif type(x) == int:
+            flow = (destination_ip, destination_port, source_ip, source_port)
+            request = q.match_response(flow)
+
+            if request is None:  # No matching request packet
+                self.metrics.drop("response_without_request")
+                return None
+
+            req, command, req_arg = request
+
+            if x == 0:
+                self.metrics.drop("missing_response_code")
+                return None
+
+            if req_arg == "":
+                self.metrics.drop("missing_argument")
+                return None
+
+            return parse_ftp_transaction(req, pkt, flow, command, req_arg, x)
+
+        return None
@@ -0,0 +1,755 @@
+import mmap
+import os
+import socket
+import struct
+from collections import deque
+from typing import Iterator, NamedTuple
+
+
+class PcapPacket(NamedTuple):
+    sniff_timestamp: str
+    protocols: str
+    ip_src: str
+    ip_dst: str
+    ipv6_src: str
+    ipv6_dst: str
+    tcp_srcport: str
+    tcp_dstport: str
+    udp_srcport: str
+    udp_dstport: str
+    http_request: str
+    http_response: str
+    http_request_method: str
+    http_response_code: str
+    http_request_full_uri: str
+    ftp_request: str
+    ftp_request_command: str
+    ftp_request_arg: str
+    ftp_response_code: str
+    ftp_response_arg: str
+
+    @property
+    def layers(self) -> list[str]:
+        return self.protocols.split(":")
+
+
+# Classic pcap magic as read from disk -> (byte order, timestamp digits)
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 6),
+    b"\xa1\xb2\xc3\xd4": (">", 6),
+    b"\x4d\x3c\xb2\xa1": ("<", 9),
+    b"\xa1\xb2\x3c\x4d": (">", 9),
+}
+
+PCAPNG_SECTION_HEADER = b"\x0a\x0d\x0d\x0a"
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+PCAPNG_SECTION_HEADER_BLOCK = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_TSRESOL = 9
+
+# Link types -> frame.protocols prefix
+LINK_LAYERS = {
+    0: "null",
+    1: "eth:ethertype",
+    12: "raw",
+    14: "raw",
+    101: "raw",
+    108: "loop",
+    113: "sll:ethertype",
+    276: "sll:ethertype",
+}
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLANS = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_TCP = 6
+
+# IPv6 extension headers skipped on the way to TCP. Fragments (44) are not
+# reassembled.
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_AUTHENTICATION_HEADER = 51
+
+TCP_FIN = 0x01
+TCP_RST = 0x04
+
+FTP_PORT = 21
+
+HTTP_MESSAGE_STARTS = (
+    b"GET ",
+    b"POST ",
+    b"PUT ",
+    b"DELETE ",
+    b"HEAD ",
+    b"OPTIONS ",
+    b"PATCH ",
+    b"CONNECT ",
+    b"TRACE ",
+    b"HTTP/1.",
+)
+
+# Headers or lines that grow past this without ending are not HTTP or FTP
+MAX_BUFFERED_BYTES = 1 << 16
+
+SEQ_MODULUS = 1 << 32
+SEQ_HALF = 1 << 31
+
+# (source ip, source port, destination ip, destination port), addresses packed
+HalfFlow = tuple[bytes, int, bytes, int]
+
+
+class TcpSegment(NamedTuple):
+    ip_layer: str
+    src: bytes
+    dst: bytes
+    sport: int
+    dport: int
+    seq: int
+    flags: int
+    payload: bytes
+
+
+def timestamp_str(ticks: int, resolution: int) -> str:
+    # pcapng if_tsresol: the high bit selects a power of two, otherwise a
+    # power of ten
+    if resolution & 0x80:
+        return repr(ticks / (1 << (resolution & 0x7F)))
+
+    if resolution == 0:
+        return str(ticks)
+
+    scale = 10**resolution
+
+    return f"{ticks // scale}.{ticks % scale:0{resolution}d}"
+
+
+def pcap_frames(
+    buf: mmap.mmap | bytes, header: bytes, offset: int, end: int
+) -> Iterator[tuple[str, int, bytes]]:
+    endian, digits = PCAP_MAGICS[header[:4]]
+    record = struct.Struct(endian + "IIII")
+
+    (linktype,) = struct.unpack_from(endian + "I", header, 20)
+    # The upper bits may carry FCS flags
+    linktype &= 0x0FFFFFFF
+
+    while offset + 16 <= end:
+        seconds, fraction, captured, _ = record.unpack_from(buf, offset)
+        offset += 16
+
+        yield (
+            f"{seconds}.{fraction:0{digits}d}",
+            linktype,
+            buf[offset : offset + captured],
+        )
+
+        offset += captured
+
+
+def pcapng_interface(
+    buf: mmap.mmap | bytes, endian: str, offset: int, end: int
+) -> tuple[int, int]:
+    (linktype,) = struct.unpack_from(endian + "H", buf, offset + 8)
+    resolution = 6
+
+    offset += 16
+
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, offset)
+
+        if code == PCAPNG_OPTION_END:
+            break
+
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            resolution = buf[offset + 4]
+
+        offset += 4 + ((length + 3) & ~3)
+
+    return linktype, resolution
+
+
+class PcapngSection:
+    def __init__(self) -> None:
+        self.endian = "<"
+        # (link type, timestamp resolution) by interface id
+        self.interfaces: list[tuple[int, int]] = []
+
+
+def pcapng_block(
+    buf: mmap.mmap | bytes, offset: int, section: PcapngSection
+) -> tuple[int, int]:
+    if buf[offset : offset + 4] == PCAPNG_SECTION_HEADER:
+        # Every section sets its own byte order and interfaces
+        (magic,) = struct.unpack_from("<I", buf, offset + 8)
+        section.endian = "<" if magic == PCAPNG_BYTE_ORDER_MAGIC else ">"
+        section.interfaces = []
+
+    block_type, block_length = struct.unpack_from(section.endian + "II", buf, offset)
+
+    if block_length < 12:
+        raise ValueError(f"Invalid pcapng block length {block_length}")
+
+    return block_type, block_length
+
+
+def pcapng_frames(
+    buf: mmap.mmap | bytes, offset: int, end: int, section: PcapngSection
+) -> Iterator[tuple[str, int, bytes]]:
+    while offset + 12 <= end:
+        block_type, block_length = pcapng_block(buf, offset, section)
+
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            section.interfaces.append(
+                pcapng_interface(
+                    buf, section.endian, offset, offset + block_length - 4
+                )
+            )
+
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, captured = struct.unpack_from(
+                section.endian + "IIII", buf, offset + 8
+            )
+
+            # Packets on an interface that was never described are skipped,
+            # as pcapng_records does
+            if interface < len(section.interfaces):
+                linktype, resolution = section.interfaces[interface]
+                data = offset + 28
+
+                yield (
+                    timestamp_str((high << 32) | low, resolution),
+                    linktype,
+                    buf[data : data + captured],
+                )
+
+        # Simple packet blocks carry no timestamp and are skipped
+
+        offset += block_length
+
+
+class CaptureSlice(NamedTuple):
+    # File header, or pcapng section header and interface blocks, that the
+    # range is read with
+    preamble: bytes
+    begin: int
+    end: int
+    # Leading frames read only to rebuild TCP state, owned by the previous
+    # slice
+    skip: int
+
+
+# Offset of every packet record, with the (offset, length) of the header
+# blocks it is read with
+def pcap_records(
+    buf: mmap.mmap,
+) -> Iterator[tuple[int, tuple[tuple[int, int], ...]]]:
+    endian, _ = PCAP_MAGICS[buf[:4]]
+    record = struct.Struct(endian + "8xI")
+    header = ((0, 24),)
+
+    offset = 24
+    end = len(buf)
+
+    while offset + 16 <= end:
+        yield offset, header
+
+        (captured,) = record.unpack_from(buf, offset)
+        offset += 16 + captured
+
+
+def pcapng_records(
+    buf: mmap.mmap,
+) -> Iterator[tuple[int, tuple[tuple[int, int], ...]]]:
+    section = PcapngSection()
+    header: tuple[tuple[int, int], ...] = ()
+
+    offset = 0
+    end = len(buf)
+
+    while offset + 12 <= end:
+        block_type, block_length = pcapng_block(buf, offset, section)
+
+        if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+            header = ((offset, block_length),)
+
+        elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            header += ((offset, block_length),)
+
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            (interface,) = struct.unpack_from(section.endian + "I", buf, offset + 8)
+
+            # The section header is followed by one block per interface
+            if interface < len(header) - 1:
+                yield offset, header
+
+        offset += block_length
+
+
+def capture_slices(
+    buf: mmap.mmap, packets_per_slice: int, overlap: int
+) -> list[CaptureSlice]:
+    magic = buf[:4]
+
+    if magic in PCAP_MAGICS:
+        records = pcap_records(buf)
+
+    elif magic == PCAPNG_SECTION_HEADER:
+        records = pcapng_records(buf)
+
+    else:
+        raise ValueError("Not a pcap or pcapng file")
+
+    # Records from the last slice boundary minus the overlap, so each slice
+    # can start early enough to see the TCP segments leading up to it
+    recent: deque[tuple[int, tuple[tuple[int, int], ...]]] = deque(
+        maxlen=overlap + 1
+    )
+    # (first record read, its header blocks, records skipped, first record
+    # owned) of each slice
+    starts: list[tuple[int, tuple[tuple[int, int], ...], int, int]] = []
+
+    for i, record in enumerate(records):
+        recent.append(record)
+
+        if i % packets_per_slice == 0:
+            starts.append((*recent[0], len(recent) - 1, record[0]))
+
+    slices = []
+
+    for i, (begin, header, skip, _) in enumerate(starts):
+        end = starts[i + 1][3] if i + 1 < len(starts) else len(buf)
+        preamble = b"".join(buf[o : o + n] for o, n in header)
+
+        slices.append(CaptureSlice(preamble, begin, end, skip))
+
+    return slices
+
+
+def pcapfile_slices(
+    pcap_filepath: str, packets_per_slice: int, overlap: int
+) -> list[CaptureSlice]:
+    if os.path.getsize(pcap_filepath) == 0:
+        return []
+
+    with open(pcap_filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return capture_slices(buf, packets_per_slice, overlap)
+
+
+def capture_frames(
+    buf: mmap.mmap, capture_slice: CaptureSlice | None = None
+) -> Iterator[tuple[str, int, bytes]]:
+    magic = buf[:4]
+
+    if magic in PCAP_MAGICS:
+        if capture_slice is None:
+            return pcap_frames(buf, buf[:24], 24, len(buf))
+
+        return pcap_frames(
+            buf, capture_slice.preamble, capture_slice.begin, capture_slice.end
+        )
+
+    if magic == PCAPNG_SECTION_HEADER:
+        section = PcapngSection()
+
+        if capture_slice is None:
+            return pcapng_frames(buf, 0, len(buf), section)
+
+        # The preamble holds no packets, it only sets up the section
+        preamble = capture_slice.preamble
+
+        for _ in pcapng_frames(preamble, 0, len(preamble), section):
+            pass
+
+        return pcapng_frames(buf, capture_slice.begin, capture_slice.end, section)
+
+    raise ValueError("Not a pcap or pcapng file")
+
+
+def network_layer(linktype: int, frame: bytes) -> tuple[int, int] | None:
+    # Ethertype and offset of the network layer header
+    if linktype == 1:
+        offset = 12
+        (ethertype,) = struct.unpack_from(">H", frame, offset)
+
+        while ethertype in ETHERTYPE_VLANS:
+            offset += 4
+            (ethertype,) = struct.unpack_from(">H", frame, offset)
+
+        return ethertype, offset + 2
+
+    if linktype == 113:
+        return struct.unpack_from(">H", frame, 14)[0], 16
+
+    if linktype == 276:
+        return struct.unpack_from(">H", frame, 0)[0], 20
+
+    if linktype in (12, 14, 101):
+        offset = 0
+
+    elif linktype in (0, 108):
+        offset = 4
+
+    else:
+        return None
+
+    version = frame[offset] >> 4
+
+    if version == 4:
+        return ETHERTYPE_IPV4, offset
+
+    if version == 6:
+        return ETHERTYPE_IPV6, offset
+
+    return None
+
+
+def tcp_segment(frame: bytes, ethertype: int, offset: int) -> TcpSegment | None:
+    if ethertype == ETHERTYPE_IPV4:
+        ip_layer = "ip"
+        header_length = (frame[offset] & 0x0F) * 4
+        (total_length, fragment) = struct.unpack_from(">H2xH", frame, offset + 2)
+
+        # Fragments are not reassembled
+        if fragment & 0x3FFF or frame[offset + 9] != IPPROTO_TCP:
+            return None
+
+        src = frame[offset + 12 : offset + 16]
+        dst = frame[offset + 16 : offset + 20]
+
+        # A zero length is left by segmentation offload
+        end = offset + total_length if total_length else len(frame)
+        offset += header_length
+
+    elif ethertype == ETHERTYPE_IPV6:
+        ip_layer = "ipv6"
+        (payload_length,) = struct.unpack_from(">H", frame, offset + 4)
+        next_header = frame[offset + 6]
+
+        src = frame[offset + 8 : offset + 24]
+        dst = frame[offset + 24 : offset + 40]
+
+        end = offset + 40 + payload_length if payload_length else len(frame)
+        offset += 40
+
+        while next_header != IPPROTO_TCP:
+            if next_header in IPV6_EXTENSION_HEADERS:
+                length = (frame[offset + 1] + 1) * 8
+
+            elif next_header == IPV6_AUTHENTICATION_HEADER:
+                length = (frame[offset + 1] + 2) * 4
+
+            else:
+                return None
+
+            next_header = frame[offset]
+            offset += length
+
+    else:
+        return None
+
+    sport, dport, seq, flags = struct.unpack_from(">HHI4xH", frame, offset)
+    data = offset + (flags >> 12) * 4
+
+    return TcpSegment(
+        ip_layer, src, dst, sport, dport, seq, flags & 0x3F, frame[data:end]
+    )
+
+
+def address_str(address: bytes) -> str:
+    if len(address) == 4:
+        return socket.inet_ntoa(address)
+
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def header_value(lines: list[str], name: str) -> str | None:
+    prefix = name.lower() + ":"
+
+    for line in lines:
+        if line.lower().startswith(prefix):
+            return line[len(prefix) :].strip()
+
+    return None
+
+
+class HalfStream:
+    def __init__(self, next_seq: int) -> None:
+        self.next_seq = next_seq
+        # Start of an HTTP head or FTP line still waiting for its end
+        self.buffer = bytearray()
+
+
+# Follows each direction of every TCP connection far enough to read HTTP
+# heads and FTP control lines. Bodies are skipped, and a gap in the sequence
+# numbers drops whatever was buffered.
+class TcpReassembler:
+    def __init__(self) -> None:
+        self.streams: dict[HalfFlow, HalfStream] = {}
+        # Full URIs of unanswered HTTP requests on each flow, oldest first
+        self.http_requests: dict[HalfFlow, deque[str]] = {}
+
+    def feed(
+        self, timestamp: str, link_layer: str, segment: TcpSegment
+    ) -> Iterator[PcapPacket]:
+        key = (segment.src, segment.sport, segment.dst, segment.dport)
+        payload = segment.payload
+
+        if payload:
+            payload = self._in_order(key, segment.seq, payload)
+
+        if payload:
+            stream = self.streams[key]
+            ftp = FTP_PORT in (segment.sport, segment.dport)
+
+            if stream.buffer or ftp or payload.startswith(HTTP_MESSAGE_STARTS):
+                stream.buffer += payload
+
+                if ftp:
+                    packet = self._ftp_packet(timestamp, link_layer, segment, stream)
+
+                    if packet is not None:
+                        yield packet
+
+                else:
+                    yield from self._http_packets(timestamp, link_layer, segment, stream)
+
+                if len(stream.buffer) > MAX_BUFFERED_BYTES:
+                    stream.buffer.clear()
+
+        if segment.flags & (TCP_FIN | TCP_RST):
+            reverse = (segment.dst, segment.dport, segment.src, segment.sport)
+
+            # A side that has closed sends no more responses, but a client
+            # that half-closes can still be answered
+            self.streams.pop(key, None)
+            self.http_requests.pop(reverse, None)
+
+            if segment.flags & TCP_RST:
+                self.streams.pop(reverse, None)
+                self.http_requests.pop(key, None)
+
+    def _in_order(self, key: HalfFlow, seq: int, payload: bytes) -> bytes:
+        stream = self.streams.get(key)
+
+        if stream is None:
+            stream = self.streams[key] = HalfStream(seq)
+
+        shift = (seq - stream.next_seq) % SEQ_MODULUS
+
+        if shift >= SEQ_HALF:
+            # Retransmission, keep only the bytes not seen yet
+            seen = SEQ_MODULUS - shift
+
+            if seen >= len(payload):
+                return b""
+
+            payload = payload[seen:]
+
+        elif shift:
+            # Bytes were lost, so a buffered head can never complete
+            stream.buffer.clear()
+
+        stream.next_seq = (seq + len(payload)) % SEQ_MODULUS
+
+        return payload
+
+    def _http_packets(
+        self,
+        timestamp: str,
+        link_layer: str,
+        segment: TcpSegment,
+        stream: HalfStream,
+    ) -> Iterator[PcapPacket]:
+        buffer = stream.buffer
+
+        while (end := buffer.find(b"\r\n\r\n")) >= 0:
+            head = buffer[:end].decode("utf-8", errors="replace")
+            del buffer[: end + 4]
+
+            packet = self._http_packet(timestamp, link_layer, segment, head)
+
+            if packet is not None:
+                yield packet
+
+            # Whatever follows is a body unless another message is pipelined
+            if not buffer.startswith(HTTP_MESSAGE_STARTS):
+                buffer.clear()
+
+    def _http_packet(
+        self, timestamp: str, link_layer: str, segment: TcpSegment, head: str
+    ) -> PcapPacket | None:
+        lines = head.split("\r\n")
+        parts = lines[0].split(" ", 2)
+
+        if parts[0].startswith("HTTP/"):
+            if len(parts) < 2:
+                return None
+
+            # The response inherits the URI of the request it answers
+            flow = (segment.dst, segment.dport, segment.src, segment.sport)
+            pending = self.http_requests.get(flow)
+            uri = pending.popleft() if pending else ""
+
+            return self._packet(
+                timestamp,
+                link_layer,
+                segment,
+                "http",
+                http_response="1",
+                http_response_code=parts[1],
+                http_request_full_uri=uri,
+            )
+
+        if len(parts) < 3 or not parts[2].startswith("HTTP/"):
+            return None
+
+        method, uri, _ = parts
+
+        # Origin-form URIs are completed with the Host header, which is
+        # required for a full URI
+        if not uri.startswith(("http://", "https://")):
+            host = header_value(lines[1:], "Host")
+            uri = f"http://{host}{uri}" if host is not None else ""
+
+        flow = (segment.src, segment.sport, segment.dst, segment.dport)
+        self.http_requests.setdefault(flow, deque()).append(uri)
+
+        return self._packet(
+            timestamp,
+            link_layer,
+            segment,
+            "http",
+            http_request="1",
+            http_request_method=method,
+            http_request_full_uri=uri,
+        )
+
+    def _ftp_packet(
+        self,
+        timestamp: str,
+        link_layer: str,
+        segment: TcpSegment,
+        stream: HalfStream,
+    ) -> PcapPacket | None:
+        buffer = stream.buffer
+        end = buffer.rfind(b"\n")
+
+        if end < 0:
+            return None
+
+        # Like tshark, report the first line completed by this segment
+        lines = buffer[:end].decode("utf-8", errors="replace").split("\n")
+        del buffer[: end + 1]
+
+        line = lines[0].rstrip("\r")
+
+        if segment.dport == FTP_PORT:
+            command, _, arg = line.partition(" ")
+
+            return self._packet(
+                timestamp,
+                link_layer,
+                segment,
+                "ftp",
+                ftp_request="1",
+                ftp_request_command=command,
+                ftp_request_arg=arg,
+            )
+
+        code = line[:3] if line[:3].isdigit() else ""
+
+        return self._packet(
+            timestamp,
+            link_layer,
+            segment,
+            "ftp",
+            ftp_request="0",
+            ftp_response_code=code,
+            ftp_response_arg=line[4:] if code else line,
+        )
+
+    @staticmethod
+    def _packet(
+        timestamp: str,
+        link_layer: str,
+        segment: TcpSegment,
+        application_layer: str,
+        **fields: str,
+    ) -> PcapPacket:
+        src = address_str(segment.src)
+        dst = address_str(segment.dst)
+        ipv4 = segment.ip_layer == "ip"
+
+        return PcapPacket(
+            sniff_timestamp=timestamp,
+            protocols=f"{link_layer}:{segment.ip_layer}:tcp:{application_layer}",
+            ip_src=src if ipv4 else "",
+            ip_dst=dst if ipv4 else "",
+            ipv6_src="" if ipv4 else src,
+            ipv6_dst="" if ipv4 else dst,
+            tcp_srcport=str(segment.sport),
+            tcp_dstport=str(segment.dport),
+            udp_srcport="",
+            udp_dstport="",
+            http_request=fields.get("http_request", ""),
+            http_response=fields.get("http_response", ""),
+            http_request_method=fields.get("http_request_method", ""),
+            http_response_code=fields.get("http_response_code", ""),
+            http_request_full_uri=fields.get("http_request_full_uri", ""),
+            ftp_request=fields.get("ftp_request", ""),
+            ftp_request_command=fields.get("ftp_request_command", ""),
+            ftp_request_arg=fields.get("ftp_request_arg", ""),
+            ftp_response_code=fields.get("ftp_response_code", ""),
+            ftp_response_arg=fields.get("ftp_response_arg", ""),
+        )
+
+
+def pcapfile_to_packets(
+    pcap_filepath: str, capture_slice: CaptureSlice | None = None
+) -> Iterator[PcapPacket]:
+    # Yields the HTTP and FTP packets tshark would print for the same file,
+    # without needing tshark
+    if os.path.getsize(pcap_filepath) == 0:
+        return
+
+    reassembler = TcpReassembler()
+    skip = capture_slice.skip if capture_slice is not None else 0
+
+    with open(pcap_filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            frames = capture_frames(buf, capture_slice)
+
+            for i, (timestamp, linktype, frame) in enumerate(frames):
+                link_layer = LINK_LAYERS.get(linktype)
+
+                if link_layer is None:
+                    continue
+
+                try:
+                    network = network_layer(linktype, frame)
+
+                    if network is None:
+                        continue
+
+                    segment = tcp_segment(frame, *network)
+
+                # Truncated by the snapshot length
+                except (IndexError, struct.error):
+                    continue
+
+                if segment is None:
+                    continue
+
+                packets = reassembler.feed(timestamp, link_layer, segment)
+
+                if i < skip:
+                    # Packets before the slice belong to the previous one
+                    for _ in packets:
+                        pass
+
+                else:
+                    yield from packets
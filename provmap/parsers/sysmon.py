@@ -1,12 +1,44 @@
+import json
+import mmap
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from typing import Iterable, Iterator
+
 import dateutil.parser
 import dateutil.tz
 
-from Evtx.Evtx import Evtx
+from Evtx.Evtx import ChunkHeader, Evtx
+from lxml import etree
 import xmltodict
 
 from provmap.events.event import Event
 from provmap.events import sysmon
-from provmap.parsers.parser import Parser
+from provmap.parsers import evtx
+from provmap.parsers.parser import Parser, ParserMetrics
+
+
+# Cheap probe for the EventID of a line-oriented XML record
+EVENT_ID_PATTERN = re.compile(rb"<EventID[^>]*>\s*(\d+)\s*</EventID>")
+
+# Format Sysmon writes UtcTime and CreationUtcTime in
+UTC_TIME_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3}")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Size of every EVTX chunk, including its header
+EVTX_CHUNK_SIZE = 0x10000
+
+# 64 KiB chunks handed to each worker task when parsing EVTX in parallel
+EVTX_CHUNKS_PER_TASK = 16
+
+# Bytes of a line-oriented export read as one range, cut at the next newline
+LINES_BYTES_PER_TASK = 1 << 22
+
+LINE_XML_PARSER = etree.XMLParser(resolve_entities=False, huge_tree=True)
 
 
 def xml_to_dict(xml_str: str) -> dict:
@@ -27,29 +59,266 @@ def xml_to_dict(xml_str: str) -> dict:
     }
 
 
-def evtx_to_dicts(evtx_filepath: str):
+def xml_bytes_to_dict(xml: bytes) -> dict:
+    root = etree.fromstring(xml, LINE_XML_PARSER)
+
+    event_id = root.find("{*}System/{*}EventID")
+    event_data = root.find("{*}EventData")
+
+    if event_id is None or event_data is None:
+        raise ValueError("Missing EventID or EventData")
+
+    # Same text handling as xmltodict: surrounding whitespace is stripped and
+    # empty elements become empty strings
+    return {
+        "EventID": int(event_id.text),
+        "EventData": {
+            data.attrib["Name"]: (data.text or "").strip()
+            for data in event_data.iterfind("{*}Data")
+        },
+    }
+
+
+def evtx_record_xml_to_dict(record) -> dict:
+    xml_str = record.xml()
+
+    try:
+        return xml_to_dict(xml_str)
+
+    except Exception as e:
+        raise ValueError("Could not parse event")
+
+
+def evtx_chunk_count(evtx_filepath: str) -> int:
     with Evtx(evtx_filepath) as log:
-        for record in log.records():
-            xml_str = record.xml()
+        return sum(1 for _ in log.chunks())
 
-            try:
-                yield xml_to_dict(xml_str)
 
-            except Exception as e:
-                raise ValueError("Could not parse event")
+def evtx_chunk_range(log: Evtx, start: int, stop: int) -> Iterator[ChunkHeader]:
+    # Chunks are laid out back to back after the file header, so a range is
+    # located by offset instead of walking every chunk before it
+    header = log.get_file_header()
+    offset = header.offset() + header.header_chunk_size()
+
+    for i in range(start, stop):
+        yield ChunkHeader(log._buf, offset + i * EVTX_CHUNK_SIZE)
+
 
+def evtx_chunks_to_dicts(
+    evtx_filepath: str,
+    start: int,
+    stop: int,
+    event_ids: frozenset[int] | None = None,
+) -> list[dict]:
+    # Decode substitution values straight from BinXML, falling back to XML
+    # rendering for records whose template is not understood
+    with Evtx(evtx_filepath) as log:
+        return [
+            event_dict
+            for chunk in evtx_chunk_range(log, start, stop)
+            for event_dict in evtx.chunk_to_dicts(
+                chunk, evtx_record_xml_to_dict, event_ids
+            )
+        ]
+
+
+def ordered_parallel_dicts(
+    range_func,
+    filepath: str,
+    ranges: list[tuple[int, int]],
+    event_ids: frozenset[int] | None,
+    workers: int,
+):
+    # Only a few ranges are in flight at once to keep memory bounded, and
+    # results are yielded in submission order to preserve record order
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for start, stop in ranges:
+            pending.append(
+                executor.submit(range_func, filepath, start, stop, event_ids)
+            )
+
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+def evtx_to_dicts(
+    evtx_filepath: str, event_ids: frozenset[int] | None = None, workers: int = 1
+):
+    if workers <= 1:
+        with Evtx(evtx_filepath) as log:
+            for chunk in log.chunks():
+                yield from evtx.chunk_to_dicts(
+                    chunk, evtx_record_xml_to_dict, event_ids
+                )
+
+        return
+
+    chunk_count = evtx_chunk_count(evtx_filepath)
+    ranges = [
+        (start, min(start + EVTX_CHUNKS_PER_TASK, chunk_count))
+        for start in range(0, chunk_count, EVTX_CHUNKS_PER_TASK)
+    ]
+
+    # Chunks are self-contained, so ranges of them decode independently
+    yield from ordered_parallel_dicts(
+        evtx_chunks_to_dicts, evtx_filepath, ranges, event_ids, workers
+    )
+
+
+def lines_bytes_to_dicts(data: bytes, event_ids: frozenset[int] | None = None):
+    for line in data.splitlines():
+        if event_ids is not None:
+            match = EVENT_ID_PATTERN.search(line)
+
+            if match is not None and int(match.group(1)) not in event_ids:
+                yield {"EventID": int(match.group(1))}
+                continue
+
+        try:
+            yield xml_bytes_to_dict(line)
+
+        except Exception as e:
+            raise ValueError("Could not parse event")
+
+
+def lines_byte_ranges(buf: mmap.mmap) -> list[tuple[int, int]]:
+    ranges = []
+    start = 0
+
+    while start < len(buf):
+        end = buf.find(b"\n", start + LINES_BYTES_PER_TASK)
+        stop = len(buf) if end == -1 else end + 1
+
+        ranges.append((start, stop))
+        start = stop
+
+    return ranges
+
+
+def json_value_to_str(value) -> str:
+    if value is None:
+        return ""
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+
+    return str(value)
+
+
+def json_to_dict(obj: dict) -> dict:
+    # Winlogbeat nests the record under "winlog" with snake_case keys
+    if "winlog" in obj:
+        obj = obj["winlog"]
+        event_id, event_data = obj["event_id"], obj["event_data"]
+
+    elif "EventData" in obj:
+        event_id, event_data = obj["EventID"], obj["EventData"]
+
+    # Flat records (e.g. NXLog) carry EventData fields next to EventID
+    else:
+        event_id, event_data = obj["EventID"], obj
+
+    return {
+        "EventID": int(event_id),
+        "EventData": {k: json_value_to_str(v) for k, v in event_data.items()},
+    }
 
-def lines_to_dicts(lines_filepath: str):
-    with open(lines_filepath, "r") as f:
-        for xml_str in f:
+
+def jsonl_bytes_to_dicts(data: bytes, event_ids: frozenset[int] | None = None):
+    lines = [line for line in data.splitlines() if line.strip()]
+
+    # Decode the whole range in one call, and only go line by line to find
+    # the culprit when that fails
+    try:
+        objs = json.loads(b"[" + b",".join(lines) + b"]")
+
+    except ValueError:
+        objs = []
+
+        for line in lines:
             try:
-                yield xml_to_dict(xml_str)
+                objs.append(json.loads(line))
+
+            except ValueError as e:
+                raise ValueError(f"Could not parse event: {e}")
+
+    for obj in objs:
+        try:
+            event_dict = json_to_dict(obj)
+
+        except Exception as e:
+            raise ValueError("Could not parse event")
+
+        if event_ids is not None and event_dict["EventID"] not in event_ids:
+            yield {"EventID": event_dict["EventID"]}
+            continue
+
+        yield event_dict
+
+
+def mapped_range_to_dicts(
+    bytes_func,
+    lines_filepath: str,
+    start: int,
+    stop: int,
+    event_ids: frozenset[int] | None = None,
+) -> list[dict]:
+    with open(lines_filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return list(bytes_func(buf[start:stop], event_ids))
+
+
+def mapped_lines_to_dicts(
+    lines_filepath: str,
+    bytes_func,
+    event_ids: frozenset[int] | None = None,
+    workers: int = 1,
+):
+    if os.path.getsize(lines_filepath) == 0:
+        return
+
+    with open(lines_filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            ranges = lines_byte_ranges(buf)
+
+            if workers <= 1:
+                for start, stop in ranges:
+                    yield from bytes_func(buf[start:stop], event_ids)
+
+                return
+
+    # Ranges end on newlines, so every record lies within a single range
+    yield from ordered_parallel_dicts(
+        partial(mapped_range_to_dicts, bytes_func),
+        lines_filepath,
+        ranges,
+        event_ids,
+        workers,
+    )
 
-            except Exception as e:
-                raise ValueError("Could not parse event")
 
+def lines_to_dicts(
+    lines_filepath: str, event_ids: frozenset[int] | None = None, workers: int = 1
+):
+    return mapped_lines_to_dicts(
+        lines_filepath, lines_bytes_to_dicts, event_ids, workers
+    )
 
-def parse_utc_time(utc_time: str) -> float:
+
+def jsonl_to_dicts(
+    jsonl_filepath: str, event_ids: frozenset[int] | None = None, workers: int = 1
+):
+    return mapped_lines_to_dicts(
+        jsonl_filepath, jsonl_bytes_to_dicts, event_ids, workers
+    )
+
+
+def parse_any_utc_time(utc_time: str) -> float:
     dt = dateutil.parser.parse(utc_time)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=dateutil.tz.UTC)
@@ -58,6 +327,31 @@ def parse_utc_time(utc_time: str) -> float:
     return dt.timestamp()
 
 
+@lru_cache(maxsize=1024)
+def utc_date_seconds(date: str) -> int:
+    dt = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), tzinfo=timezone.utc)
+
+    return (dt - EPOCH).days * 86400
+
+
+def parse_utc_time(utc_time: str) -> float:
+    if UTC_TIME_PATTERN.fullmatch(utc_time) is None:
+        return parse_any_utc_time(utc_time)
+
+    hour = int(utc_time[11:13])
+    minute = int(utc_time[14:16])
+    second = int(utc_time[17:19])
+
+    # Out of range fields must not roll over into the next minute, hour or day
+    if hour > 23 or minute > 59 or second > 59:
+        return parse_any_utc_time(utc_time)
+
+    seconds = utc_date_seconds(utc_time[0:10]) + hour * 3600 + minute * 60 + second
+
+    # Same arithmetic as datetime.timestamp(), so results are bit-identical
+    return (seconds * 10**6 + int(utc_time[20:23]) * 1000) / 10**6
+
+
 def parse_hashes(hash_str: str) -> dict[str, str]:
     return dict(kv.split("=", 1) for kv in hash_str.split(",") if "=" in kv)
 
@@ -140,9 +434,53 @@ def parse_file_create(event_dict: dict) -> sysmon.FileCreate:
     )
 
 
+class FieldTracker(dict):
+    last_field: str | None = None
+
+    def __getitem__(self, key):
+        self.last_field = key
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.last_field = key
+        return super().get(key, default)
+
+
+def failed_field(parse_func, event_dict: dict) -> str | None:
+    # Replays a failed parse, which is rare, instead of tracking field access
+    # on every event
+    event_data = FieldTracker(event_dict.get("EventData", {}))
+
+    try:
+        parse_func({**event_dict, "EventData": event_data})
+
+    except Exception:
+        return event_data.last_field
+
+    return None
+
+
+EVENT_PARSERS = {
+    1: parse_process_create,
+    3: parse_network_connection,
+    # 7: parse_image_loaded,
+    11: parse_file_create,
+}
+
+
 class SysmonParser(Parser):
-    def __init__(self, filepath: str) -> None:
+    def __init__(
+        self,
+        filepath: str,
+        event_ids: Iterable[int] | None = None,
+        workers: int = 1,
+    ) -> None:
         self.filepath = filepath
+        self.event_ids = frozenset(
+            event_ids if event_ids is not None else EVENT_PARSERS.keys()
+        )
+        self.workers = workers
+        self.metrics = ParserMetrics()
         self._parsed: bool = False
         self._events: list[Event] = []
 
@@ -150,32 +488,55 @@ class SysmonParser(Parser):
         if self._parsed:
             return self._events
 
-        dict_func = evtx_to_dicts if self.filepath.endswith(".evtx") else lines_to_dicts
+        self._events = list(self.iter_events())
 
-        event_dicts = dict_func(self.filepath)
+        self._parsed = True
+        return self._events
+
+    def iter_event_dicts(self) -> Iterator[dict]:
+        if self.filepath.endswith(".evtx"):
+            return evtx_to_dicts(self.filepath, self.event_ids, self.workers)
+
+        return lines_to_dicts(self.filepath, self.event_ids, self.workers)
+
+    def iter_events(self) -> Iterator[Event]:
+        self.metrics.bytes_read += os.path.getsize(self.filepath)
+        self.metrics.start()
+
+        try:
+            for event_dict in self.iter_event_dicts():
+                self.metrics.read()
 
-        for event_dict in event_dicts:
-            try:
                 event_id = event_dict["EventID"]
 
-                if event_id == 1:
-                    event = parse_process_create(event_dict)
-                    self._events.append(event)
+                if event_id not in self.event_ids:
+                    self.metrics.drop("filtered_event_id")
+                    continue
 
-                elif event_id == 3:
-                    event = parse_network_connection(event_dict)
-                    self._events.append(event)
+                if event_id not in EVENT_PARSERS:
+                    self.metrics.drop("unsupported_event_id")
+                    continue
 
-                # elif event_id == 7:
-                #     event = parse_image_loaded(event_dict)
-                #     self._events.append(event)
+                parse_func = EVENT_PARSERS[event_id]
 
-                elif event_id == 11:
-                    event = parse_file_create(event_dict)
-                    self._events.append(event)
+                try:
+                    event = parse_func(event_dict)
 
-            except:
-                pass
+                except Exception as e:
+                    self.metrics.fail(e, failed_field(parse_func, event_dict))
+                    continue
 
-        self._parsed = True
-        return self._events
+                self.metrics.keep(event_id)
+
+                # Time spent by the consumer is not parse time
+                self.metrics.stop()
+                yield event
+                self.metrics.start()
+
+        finally:
+            self.metrics.stop()
+
+
+class SysmonJsonlParser(SysmonParser):
+    def iter_event_dicts(self) -> Iterator[dict]:
+        return jsonl_to_dicts(self.filepath, self.event_ids, self.workers)
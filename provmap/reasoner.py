@@ -1,6 +1,8 @@
 import logging
 import os
 import tempfile
+from hashlib import sha256
+from typing import Iterable
 
 
 from pyswip import Prolog
@@ -37,20 +39,115 @@ from provmap.graph.graph import Graph
 logger = logging.getLogger(__name__)
 
 
+# Bump when cached QLF files can no longer be loaded by this version
+QLF_CACHE_VERSION = 1
+
+# Recursive or heavily reused rules, evaluated with SWI-Prolog tabling so
+# cycles in the graph terminate and shared subgoals are answered once
+TABLED_PREDICATES = ("reachable/2", "malicious/1", "contaminated/1", "tag/2")
+
+
+def prolog_path(path: str) -> str:
+    # Quoted atom for a path, with forward slashes for Windows (see above)
+    return "'" + str(path).replace("\\", "/").replace("'", "\\'") + "'"
+
+
 class Reasoner:
-    def __init__(self, graph: Graph, schema_filepath: str, rules_filepath: str) -> None:
+    def __init__(
+        self,
+        graph: Graph,
+        schema_filepath: str,
+        rules_filepath: str,
+        cache_dir: str | None = None,
+        tabled: Iterable[str] = TABLED_PREDICATES,
+    ) -> None:
         logger.info("Initialising reasoner")
         self.graph = graph
         self.prolog = Prolog()
+        self.cache_dir = cache_dir
+
+        self.load(schema_filepath, rules_filepath)
+
+        # Tabling wraps the loaded predicates, so it is applied the same way
+        # whether they came from source or QLF
+        for predicate in tabled:
+            logger.info(f"Tabling {predicate}")
+            next(self.prolog.query(f"table({predicate})"))
+
+    def load(self, schema_filepath: str, rules_filepath: str) -> None:
+        cache_dir = self.cache_dir
+
+        if cache_dir is None:
+            self.prolog.consult(schema_filepath)
+            self.prolog.consult(rules_filepath)
+
+            with tempfile.NamedTemporaryFile(
+                mode="w", suffix=".pl", delete=False
+            ) as f:
+                f.write(self.graph.to_prolog())
+                graph_filepath = f.name
+
+            try:
+                self.prolog.consult(graph_filepath)
+            finally:
+                os.remove(graph_filepath)
+
+            return
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # QLF files are only readable by the Prolog version that wrote them
+        version = list(self.prolog.query("current_prolog_flag(version, V)"))[0]["V"]
+        key = sha256(f"v{QLF_CACHE_VERSION}\0{version}".encode())
+
+        sources = (("schema", schema_filepath), ("rules", rules_filepath))
+
+        for name, filepath in sources:
+            with open(filepath, "rb") as f:
+                source = f.read()
+
+            # Facts are compiled against the schema declarations and rules,
+            # so their key covers both
+            key.update(source)
+            self.load_cached(name, key.hexdigest(), source)
+
+        graph_prolog = self.graph.to_prolog()
+        key.update(graph_prolog.encode())
+
+        self.load_cached("graph", key.hexdigest(), graph_prolog.encode())
 
-        self.prolog.consult(schema_filepath)
-        self.prolog.consult(rules_filepath)
+    def load_cached(self, name: str, fingerprint: str, source: bytes) -> None:
+        qlf_filepath = os.path.join(self.cache_dir, f"{name}_{fingerprint}.qlf")
 
-        with tempfile.TemporaryFile(mode="w", suffix=".pl", delete=False) as f:
-            f.write(self.graph.to_prolog())
-            graph_filepath = f.name
+        if os.path.exists(qlf_filepath):
+            logger.info(f"Loading cached {name} from {qlf_filepath}")
 
-        self.prolog.consult(graph_filepath)
+            try:
+                query = f"load_files({prolog_path(qlf_filepath)}, [])"
+                next(self.prolog.query(query))
+
+                return
+
+            except Exception as e:
+                logger.warning(f"Discarding unreadable cached {name}: {e}")
+
+        logger.info(f"Compiling {name} to {qlf_filepath}")
+
+        # qcompile loads the source and writes its QLF next to it. The QLF
+        # is moved into place only once complete.
+        stem = os.path.join(self.cache_dir, f"{name}_{fingerprint}.{os.getpid()}")
+
+        with open(stem + ".pl", "wb") as f:
+            f.write(source)
+
+        try:
+            next(self.prolog.query(f"qcompile({prolog_path(stem + ".pl")})"))
+            os.replace(stem + ".qlf", qlf_filepath)
+
+        finally:
+            for filepath in (stem + ".pl", stem + ".qlf"):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
 
     def get_malicious_entities(self) -> list[Entity]:
         logger.info("Searching for malicious entities")
@@ -69,7 +166,7 @@ class Reasoner:
         for entity_id in entity_ids:
             logger.debug(f"malicious('{entity_id}').")
 
-            entity: Entity = self.graph.G.nodes[entity_id]["obj"]
+            entity: Entity = self.graph.get_entity(entity_id)
 
             logger.debug(f"Found entity {entity} with entity id '{entity_id}'")
 
@@ -89,4 +186,38 @@ class Reasoner:
         tags = list(set([r["Tag"] for r in results]))
         logger.debug(f"Found {len(tags)} tags")
 
-        return tags
\ No newline at end of file
+        return tags
+
+    def get_all_tags(
+        self, entities: Iterable[Entity] | None = None
+    ) -> dict[str, list[str]]:
+        # Tags of many entities from one findall, by entity id. Defaults to
+        # every entity in the graph.
+        if entities is None:
+            entity_ids = self.graph.get_entity_ids()
+            goal = "tag(EntityId, Tag)"
+
+        else:
+            entity_ids = [entity.entity_id for entity in entities]
+            id_list = ", ".join(f"'{entity_id}'" for entity_id in entity_ids)
+            goal = f"member(EntityId, [{id_list}]), tag(EntityId, Tag)"
+
+        logger.info(f"Searching for tags of {len(entity_ids)} entities")
+
+        query = f"findall([EntityId, Tag], ({goal}), Pairs)"
+
+        logger.debug(f"Sending query: {query}")
+
+        results = list(self.prolog.query(query))
+
+        tags: dict[str, dict[str, None]] = {
+            entity_id: {} for entity_id in entity_ids
+        }
+
+        for entity_id, tag in results[0]["Pairs"] if results else []:
+            if entity_id in tags:
+                tags[entity_id][tag] = None
+
+        logger.info(f"Found {sum(len(t) for t in tags.values())} tags")
+
+        return {entity_id: list(t) for entity_id, t in tags.items()}
\ No newline at end of file
@@ -1,4 +1,8 @@
-?- ['schema.pl'].
+% The Reasoner loads the schema itself, and may compile a copy of this file
+% elsewhere, so only load it when run standalone
+:- if(\+ predicate_property(user:edge(_, _, _, _), multifile)).
+:- ['schema.pl'].
+:- endif.
 
 %
 % Helpers
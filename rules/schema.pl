@@ -1,5 +1,7 @@
 :- multifile		edge/4.
 :- discontiguous	edge/4.
+:- multifile		edge_summary/6.
+:- discontiguous	edge_summary/6.
 
 :- multifile		process/1.
 :- discontiguous	process/1.
@@ -29,7 +29,12 @@ if __name__ == "__main__":
 
     entities = data["entities"]
 
-    clauses = [":- multifile\t\tedge/4.\n", ":- discontiguous\tedge/4.\n\n"]
+    clauses = [
+        ":- multifile\t\tedge/4.\n",
+        ":- discontiguous\tedge/4.\n",
+        ":- multifile\t\tedge_summary/6.\n",
+        ":- discontiguous\tedge_summary/6.\n\n",
+    ]
 
     for entity in entities:
         predicates = entity_to_prolog(entity)